@@ -0,0 +1,71 @@
+"""Measures how many messages per second Crosspost.find_links can scan.
+
+Run from the repository root with `python -m bench.crosspost_links`."""
+import random
+import time
+
+from cogs.crosspost import Crosspost
+
+WORDS = (
+    "lol that is so good honestly i can't believe they drew this "
+    "anyone up for raids tonight? brb coffee what time is the stream "
+    "omg the colors wow this artist never misses"
+).split()
+
+SUPPORTED = (
+    "https://twitter.com/artist/status/1234567890123456789",
+    "https://mobile.twitter.com/artist/status/1234567890123456789",
+    "https://www.pixiv.net/en/artworks/81234567",
+    "https://www.pixiv.net/member_illust.php?mode=medium&illust_id=81234567",
+    "https://hiccears.com/picture.php?pid=12345",
+    "https://artist.tumblr.com/post/612345678901234567",
+    "https://inkbunny.net/s/2123456",
+    "https://mastodon.social/@artist/104123456789012345",
+)
+
+UNSUPPORTED = (
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://en.wikipedia.org/wiki/Python_(programming_language)",
+    "https://www.bbc.co.uk/news/technology-52345678",
+    "https://github.com/Rapptz/discord.py",
+    "https://cdn.discordapp.com/attachments/1/2/image.png",
+)
+
+
+def make_message(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(1, 25))
+    roll = rng.random()
+    if roll < 0.7:
+        links = []
+    elif roll < 0.85:
+        links = [rng.choice(UNSUPPORTED)]
+    elif roll < 0.97:
+        links = [rng.choice(SUPPORTED)]
+    else:
+        links = rng.choices(SUPPORTED + UNSUPPORTED, k=rng.randint(2, 10))
+    for link in links:
+        if rng.random() < 0.05:
+            link = f"||{link}||"
+        elif rng.random() < 0.1:
+            link = f"<{link}>"
+        words.insert(rng.randint(0, len(words)), link)
+    return " ".join(words)
+
+
+def main(count: int = 100_000, rounds: int = 5) -> None:
+    rng = random.Random(0)
+    corpus = [make_message(rng) for _ in range(count)]
+    find_links = Crosspost.find_links
+    found = sum(1 for message in corpus if find_links(message))
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for message in corpus:
+            find_links(message)
+        best = min(best, time.perf_counter() - start)
+    print(f"{count} messages, {found} with supported links")
+    print(f"{count / best:,.0f} messages/s ({best / count * 1e6:.2f} us/message)")
+
+
+if __name__ == "__main__":
+    main()
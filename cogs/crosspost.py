@@ -2,41 +2,217 @@ from __future__ import annotations  # type: ignore
 
 import asyncio
 import json
+import os
 import re
 import traceback
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextvars import ContextVar
+from copy import copy
+from datetime import datetime, timedelta
 from hashlib import md5
 from io import BytesIO, StringIO
-from typing import Any, Dict, List, Optional, Union, Tuple, Iterable
+from multiprocessing import get_all_start_methods, get_context
+from pathlib import Path
+from tempfile import TemporaryFile
+from time import monotonic, perf_counter
+from typing import (
+    IO,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Union,
+    Tuple,
+    Iterable,
+    NamedTuple,
+    TypeVar,
+)
+from urllib.parse import parse_qs, urlsplit
 
 import aiohttp
 import toml
-from discord import File, HTTPException, Message
+from discord import (
+    Embed,
+    File,
+    HTTPException,
+    Message,
+    NotFound,
+    Object,
+    TextChannel,
+)
 from discord.ext import commands
 from discord.ext.commands import Bot, Cog
 from lxml import etree
 
 from bot import BeattieBot
 from context import BContext
+from schema.crosspost import History, Settings, Table, Upload
 from utils.checks import is_owner_or
-from utils.contextmanagers import get as get_
+from utils.contextmanagers import extend_deadline, get as get_, set_deadline
+from utils.aioutils import (
+    Batcher,
+    FairScheduler,
+    Lease,
+    SingleFlight,
+    do_every,
+    ordered,
+)
+from utils.cache import SentMessages, TTLCache
+from utils.diskcache import DiskCache
 from utils.etc import remove_spoilers
-from utils.exceptions import ResponseError
+from utils.exceptions import FileTooLarge, QueueFull, ResolveError, ResponseError
+from utils.html import parse_html
+from utils.images import Image, fit_image, guess_extension, make_gif
+from utils.metrics import Metrics, RollingCounter
+
+
+T = TypeVar("T")
+
+
+class Post(NamedTuple):
+    urls: List[str]
+    sensitive: bool = False
+    # number of leading images Discord already embeds from the link
+    skip: int = 0
+    # smaller renditions of each image, largest first
+    variants: Tuple[Tuple[str, ...], ...] = ()
+
+
+def filename_of(url: str) -> str:
+    return re.findall(r"[\w. -]+\.[\w. -]+", url)[-1]
+
+
+def post_size(post: Post) -> int:
+    return sum(map(len, post.urls)) + sum(len(url) for v in post.variants for url in v)
+
+
+def file_size(file: File) -> int:
+    fp: IO[bytes] = file.fp  # type: ignore
+    pos = fp.tell()
+    size = fp.seek(0, 2)
+    fp.seek(pos)
+    return size - pos
 
 
 class CrosspostContext(BContext):
     cog: Crosspost
+    previous: Optional[asyncio.Future]
+    lease: Optional[Lease]
+    files: List[File]
+    sources: List[Optional[str]]
+    files_size: int
+    first_post: Optional[Message]
+    link_tag: int
+
+    def __init__(self, **attrs: Any):
+        super().__init__(**attrs)
+        self.previous = None
+        self.link_tag = 0
+        self.lease = None
+        self.files = []
+        self.sources = []
+        self.files_size = 0
+        self.first_post = None
+
+    def fork(
+        self, previous: Optional[asyncio.Future], link_tag: int
+    ) -> CrosspostContext:
+        """Copy this context for handling one link of the message.
+        The copy sends nothing until previous has finished, and its replies
+        are tracked under link_tag."""
+        ctx = copy(self)
+        ctx.previous = previous
+        ctx.link_tag = link_tag
+        ctx.lease = None
+        ctx.files = []
+        ctx.sources = []
+        ctx.files_size = 0
+        ctx.first_post = None
+        return ctx
+
+    def release(self) -> None:
+        if self.lease is not None:
+            self.lease.release()
+            self.lease = None
+
+    async def resume(self, lease: Lease) -> None:
+        self.lease = await self.cog.scheduler.acquire(
+            lease.key, lease.host, resume=True
+        )
+
+    async def send_file(
+        self, file: Union[File, str], source: Optional[str] = None
+    ) -> None:
+        """Queue a file to be uploaded together with up to 9 others.
+        If file is the URL of an earlier upload, it is embedded instead.
+
+        The attachment URL is remembered for source once uploaded."""
+        if isinstance(file, str):
+            await self.send_post(embed=Embed().set_image(url=file))
+            return
+        size = file_size(file)
+        limit = self.cog.get_upload_limit(self)
+        if size > limit:
+            await self.send("Image too large to upload.")
+            return
+        if len(self.files) == 10 or self.files_size + size > limit:
+            await self.flush()
+        self.files.append(file)
+        self.sources.append(source)
+        self.files_size += size
+
+    async def flush(self) -> None:
+        if not self.files:
+            return
+        files = self.files
+        files_size = self.files_size
+        sources = self.sources
+        self.files = []
+        self.sources = []
+        self.files_size = 0
+        if self.guild is not None:
+            self.cog.usage.add(self.guild.id, files_size)
+        self.cog.metrics.observe("upload_bytes", self.cog.labels(), files_size)
+        msg = await self.send_post(files=files)
+        for source, attachment in zip(sources, msg.attachments):
+            if source is not None:
+                await self.cog.record_upload(source, attachment.url, msg)
 
     async def send(self, *args: Any, **kwargs: Any) -> Message:
+        await self.flush()
+        if self.previous is not None:
+            # wait for links earlier in the message to finish sending without
+            # holding a slot, then take one again for the rest of this link
+            lease = self.lease
+            self.release()
+            start = monotonic()
+            await asyncio.wait({self.previous})
+            self.previous = None
+            if lease is not None:
+                await self.resume(lease)
+            # as with the first slot, time spent waiting isn't counted
+            extend_deadline(monotonic() - start)
         file: File
         if file := kwargs.get("file"):  # type: ignore
-            fp: BytesIO = file.fp  # type: ignore
-            if len(fp.getvalue()) >= 8_000_000:
+            if file_size(file) > self.cog.get_upload_limit(self):
                 args = ("Image too large to upload.",)
                 kwargs = {}
         msg = await super().send(*args, **kwargs)
-        self.cog.sent_images[self.message.id].append(msg)
+        self.cog.sent_images.add(self.message.id, msg.channel.id, msg.id, self.link_tag)
+        return msg
+
+    async def send_post(self, *args: Any, **kwargs: Any) -> Message:
+        """Send a reply that crossposts something, as opposed to an error.
+        The first one is what later repeats of the link are pointed to."""
+        msg = await self.send(*args, **kwargs)
+        if self.first_post is None:
+            self.first_post = msg
         return msg
 
 
@@ -51,6 +227,10 @@ class Crosspost(Cog):
     tweet_selector = ".//div[contains(@class, 'permalink-tweet')]"
     twitter_img_selector = ".//img[@data-aria-label-part]"
 
+    @staticmethod
+    def is_tweet(element: etree._Element) -> bool:
+        return element.tag == "div" and "permalink-tweet" in element.get("class", "")
+
     pixiv_url_expr = re.compile(
         r"https?://(?:www\.)?pixiv\.net/(?:member_illust\.php\?[\w]+=[\w]+(?:&[\w]+=[\w]+)*|(?:\w{2}/)?artworks/\d+(?:#\w*)?)"
     )
@@ -61,18 +241,58 @@ class Crosspost(Cog):
     hiccears_link_selector = ".//div[contains(@class, 'row')]//a"
     hiccears_img_selector = ".//a[contains(@href, 'imgs')]"
 
+    @staticmethod
+    def is_hiccears_img(element: etree._Element) -> bool:
+        return element.tag == "a" and "imgs" in element.get("href", "")
+
     tumblr_url_expr = re.compile(r"https?://[\w-]+\.tumblr\.com/post/\d+")
     tumblr_img_selector = ".//meta[@property='og:image']"
 
-    mastodon_url_expr = re.compile(r"https?://\S+/\w+/?(?:>|$|\s)")
+    @staticmethod
+    def is_head(element: etree._Element) -> bool:
+        return element.tag == "head"
+
+    # \S can't run into another URL, so links nested in one are still found
+    mastodon_url_expr = re.compile(r"https?://(?:(?!https?://)\S)+/\w+/?(?:>|$|\s)")
     mastodon_url_groups = re.compile(r"https?://([^\s/]+)(?:/.+)+/(\w+)")
     mastodon_api_fmt = "https://{}/api/v1/statuses/{}"
+    mastodon_instance_fmt = "https://{}/api/v1/instance"
+    # domain names only, without IP addresses, ports or credentials
+    mastodon_host_expr = re.compile(r"(?:[a-z0-9-]+\.)+[a-z][a-z0-9-]+", re.I)
+    local_tlds = frozenset({"localhost", "local", "localdomain", "internal", "lan"})
 
     inkbunny_url_expr = re.compile(r"https?://inkbunny\.net/s/(\d+)(?:-p\d+-)?(?:#.*)?")
     inkbunny_api_fmt = "https://inkbunny.net/api_{}.php"
     inkbunny_sid = ""
 
-    sent_images: Dict[int, List[Message]]
+    # mastodon_url_expr matches nearly any URL, so it has to be tried last
+    link_exprs = (
+        ("twitter", twitter_url_expr),
+        ("pixiv", pixiv_url_expr),
+        ("hiccears", hiccears_url_expr),
+        ("tumblr", tumblr_url_expr),
+        ("inkbunny", inkbunny_url_expr),
+        ("mastodon", mastodon_url_expr),
+    )
+    link_expr = re.compile(
+        "|".join(f"(?P<{site}>{expr.pattern})" for site, expr in link_exprs)
+    )
+    scheme_expr = re.compile(r"^https?://(?:www\.)?")
+    # the parts of a link that identify its post
+    post_id_exprs = {
+        "twitter": re.compile(r"/status/(\d+)"),
+        "pixiv": re.compile(r"illust_id=(\d+)|artworks/(\d+)"),
+        "hiccears": re.compile(r"([gp]id=\d+)"),
+        "tumblr": re.compile(r"([\w-]+)\.tumblr\.com/post/(\d+)"),
+        "mastodon": mastodon_url_groups,
+    }
+    # index of the group passed to each display function
+    link_groups = {
+        site: index + bool(expr.groups)
+        for (site, index), (_, expr) in zip(link_expr.groupindex.items(), link_exprs)
+    }
+
+    sent_images: SentMessages
 
     def __init__(self, bot: BeattieBot):
         self.bot = bot
@@ -83,22 +303,112 @@ class Crosspost(Cog):
         with open("config/headers.toml") as fp:
             data = toml.load(fp)
         self.headers.update(data)
-        self.session = aiohttp.ClientSession(loop=bot.loop)
-        self.parser = etree.HTMLParser()
-        names = (
-            name.partition("_")[0]
-            for name in vars(type(self))
-            if name.endswith("url_expr")
+        with open("config/config.toml") as fp:
+            config = toml.load(fp).get("crosspost", {})
+        self.cache = DiskCache(
+            config.get("cache_dir", "cache/crosspost"),
+            config.get("cache_size", 1 << 30),
+        )
+        self.spool_size = config.get("spool_size", 1 << 20)
+        self.scheduler = FairScheduler(
+            config.get("max_concurrency", 16),
+            config.get("guild_concurrency", 4),
+            config.get("host_concurrency", 8),
+            config.get("queue_depth", 50),
+            {int(k): v for k, v in config.get("guild_weights", {}).items()},
+        )
+        self.mastodon_allowlist = frozenset(config.get("mastodon_allowlist", ()))
+        self.mastodon_probe = config.get("mastodon_probe", True)
+        self.mastodon_negative_ttl = config.get("mastodon_negative_ttl", 60 * 60 * 24)
+        self.embed_wait = config.get("embed_wait", 0)
+        self.link_timeout = config.get("link_timeout", 120)
+        gallery_concurrency = config.get("gallery_concurrency", 4)
+        self.gallery_slots: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(gallery_concurrency)
+        )
+        self.mastodon_hosts: TTLCache[str, bool] = TTLCache(10_000, 60 * 60 * 24 * 7)
+        self.inflight = SingleFlight()
+        self.inkbunny_batch: Batcher[str, Post] = Batcher(
+            self.resolve_inkbunny, config.get("inkbunny_batch_delay", 0.05), 100
+        )
+        self.transcoder: Optional[ProcessPoolExecutor] = None
+        self.transcode_workers = config.get("transcode_workers", 2)
+        if Image is not None:
+            self.transcoder = self.new_transcoder()
+        self.transcode = config.get("transcode", True)
+        self.transcode_max_size = config.get("transcode_max_size", 50_000_000)
+        self.transcode_timeout = config.get("transcode_timeout", 30)
+        self.transcode_cpu = config.get("transcode_cpu", 20)
+        self.post_ttl = config.get("post_ttl", 60 * 60)
+        self.post_negative_ttl = config.get("post_negative_ttl", 60 * 10)
+        self.posts: TTLCache[Tuple[str, str], Optional[Post]] = TTLCache(
+            config.get("post_cache_size", 1 << 22),
+            self.post_ttl,
+            lambda post: 64 + (post is not None and post_size(post)),
         )
-        self.expr_dict = {
-            getattr(self, f"{name}_url_expr"): getattr(self, f"display_{name}_images")
-            for name in names
+        # a session of its own to keep site cookies apart from other cogs
+        self.session = bot.transport.session(loop=bot.loop)
+        self.link_funcs = {
+            site: getattr(self, f"display_{site}_images") for site in self.link_groups
         }
-        self.sent_images = defaultdict(list)
+        self.sent_images = SentMessages(
+            config.get("sent_max", 100_000), config.get("sent_ttl", 60 * 60 * 24)
+        )
+        self.history_ttl = config.get("history_ttl", 60 * 60 * 24 * 7)
+        self.history: TTLCache[Tuple[int, str], Tuple[int, datetime]] = TTLCache(
+            config.get("history_size", 100_000), self.history_ttl
+        )
+        # dedupe window in minutes of each guild that has one
+        self.dedupe_windows: Dict[int, int] = {}
+        self.budget = config.get("budget", 2 << 30)
+        self.guild_budgets = {
+            int(k): v for k, v in config.get("guild_budgets", {}).items()
+        }
+        self.usage = RollingCounter(config.get("budget_window", 60 * 60 * 24))
+        self.metrics = Metrics()
+        self.budget_economy = config.get("budget_economy", 0.5)
+        # last known sizes of images too large to upload somewhere
+        self.sizes: TTLCache[str, int] = TTLCache(10_000, 60 * 60)
+        self.uploads: TTLCache[str, Optional[str]] = TTLCache(
+            config.get("upload_cache_size", 100_000),
+            config.get("upload_check_ttl", 60 * 60),
+        )
+        self.bot.db.bind_tables(Table)
+        self.db_task = bot.loop.create_task(self.init_db())
         self.login_task = self.bot.loop.create_task(self.pixiv_login_loop())
+        self.dump_task = do_every(
+            config.get("cache_dump_interval", 60), self.dump_cache
+        )
         self.init_task = bot.loop.create_task(self.__init())
 
     async def __init(self) -> None:
+        await self.inkbunny_login()
+
+    async def init_db(self) -> None:
+        await self.bot.wait_until_ready()
+        for table in (History, Settings, Upload):
+            await table.create(if_not_exists=True)
+        await self.load_settings()
+        await self.load_history()
+
+    async def load_settings(self) -> None:
+        async with self.bot.db.get_session() as s:
+            async for row in await s.select(Settings).all():
+                if row.dedupe:
+                    self.dedupe_windows[row.guild_id] = row.dedupe
+
+    async def load_history(self) -> None:
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.history_ttl)
+        async with self.bot.db.get_session() as s:
+            await s.delete(History).where(History.time < cutoff)
+            query = s.select(History).where(History.time >= cutoff)
+            async for row in await query.all():
+                ttl = self.history_ttl - (now - row.time).total_seconds()
+                key = (row.channel_id, row.post)
+                self.history.set(key, (row.message_id, row.time), ttl)
+
+    async def inkbunny_login(self) -> None:
         with open("config/logins.toml") as fp:
             login = toml.load(fp)["inkbunny"]
         url = self.inkbunny_api_fmt.format("login")
@@ -145,76 +455,632 @@ class Crosspost(Cog):
                 toml.dump(logins, fp)
             await asyncio.sleep(res["expires_in"] / 2)
 
+    async def dump_cache(self) -> None:
+        try:
+            await self.bot.loop.run_in_executor(None, self.cache.dump)
+        except OSError:
+            pass  # the index is still dirty, so it's written next time
+
     def cog_unload(self) -> None:
         self.bot.loop.create_task(self.session.close())
         self.login_task.cancel()
+        self.db_task.cancel()
+        self.dump_task.cancel()
+        self.bot.loop.create_task(self.dump_cache())
+        if self.transcoder is not None:
+            self.transcoder.shutdown(wait=False)
 
     def get(self, url: str, method: str = "GET", **kwargs: Any) -> get_:
         kwargs["headers"] = {**self.headers, **kwargs.get("headers", {})}
         return get_(self.session, url, method, **kwargs)
 
     async def save(
-        self, img_url: str, headers: Optional[Dict[str, str]] = None
-    ) -> BytesIO:
+        self,
+        img_url: str,
+        headers: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None,
+    ) -> IO[bytes]:
+        if (fp := self.cache.open(img_url)) is not None:
+            self.metrics.incr("file_cache_hit", self.labels())
+        else:
+            self.metrics.incr("file_cache_miss", self.labels())
+            key = ("save", img_url, limit)
+            fp = await self.open_shared(key, self.download, img_url, headers, limit)
+        size = os.fstat(fp.fileno()).st_size
+        if limit is not None and size > limit:
+            fp.close()
+            raise FileTooLarge(size, img_url)
+        return fp
+
+    async def open_shared(
+        self, flight: Hashable, func: Callable[..., Awaitable[Path]], *args: Any
+    ) -> IO[bytes]:
+        """Open the cached file func returns the path of, sharing the call with
+        concurrent callers. func is called again if the file is evicted first."""
+        path = await self.inflight.do(flight, func, *args)
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            path = await self.inflight.do(flight, func, *args)
+            return open(path, "rb")
+
+    async def download(
+        self,
+        img_url: str,
+        headers: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None,
+    ) -> Path:
         headers = headers or {}
         headers = {**self.headers, **headers}
-        img = BytesIO()
-        async with self.get(img_url, headers=headers) as img_resp:
-            async for chunk in img_resp.content.iter_any():
-                if not chunk:
-                    break
-                img.write(chunk)
+        img: IO[bytes] = BytesIO()
+        size = 0
+        start = perf_counter()
+        try:
+            async with self.get(img_url, headers=headers) as img_resp:
+                if (length := img_resp.content_length) is not None:
+                    if limit is not None and length > limit:
+                        raise FileTooLarge(length, img_url)
+                    if length > self.spool_size:
+                        img = TemporaryFile()
+                async for chunk in img_resp.content.iter_any():
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if limit is not None and size > limit:
+                        img.close()
+                        raise FileTooLarge(size, img_url)
+                    if size > self.spool_size and isinstance(img, BytesIO):
+                        spool = TemporaryFile()
+                        spool.write(img.getbuffer())
+                        img = spool
+                    img.write(chunk)
+        finally:
+            if (guild_id := charged_guild.get()) is not None:
+                self.usage.add(guild_id, size)
+            labels = self.labels()
+            self.metrics.observe("download_time", labels, perf_counter() - start)
+            self.metrics.observe("download_bytes", labels, size)
         img.seek(0)
-        return img
+        with img:
+            return await self.bot.loop.run_in_executor(
+                None, self.cache.put, img_url, img
+            )
 
-    async def process_links(self, ctx: CrosspostContext) -> None:
-        content = remove_spoilers(ctx.message.content)
-        for expr, func in self.expr_dict.items():
-            for link in expr.findall(content):
-                try:
-                    await func(link, ctx)
-                except Exception as e:
-                    await ctx.bot.handle_error(ctx, e)
+    @classmethod
+    def find_links(cls, content: str) -> List[Tuple[int, str, str]]:
+        """Returns the position, site and link of each supported link in content,
+        in order of appearance."""
+        if "http" not in content:
+            return []
+        return [
+            (match.start(), site, match.group(cls.link_groups[site]))
+            for match in cls.link_expr.finditer(remove_spoilers(content))
+            if (site := match.lastgroup) is not None
+        ]
+
+    async def save_file(
+        self,
+        img_url: str,
+        filename: str,
+        headers: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None,
+        transcode: bool = True,
+    ) -> File:
+        """Like save, but re-encodes images over limit to fit when possible."""
+        try:
+            img = await self.save(img_url, headers, limit)
+        except FileTooLarge as e:
+            self.metrics.incr("oversize", self.labels())
+            if e.size is not None:
+                self.sizes.set(img_url, e.size)
+            if not (transcode and self.transcode) or limit is None:
+                raise
+            if self.transcoder is None:
+                raise
+            key = ("transcode", img_url, limit)
+            img = await self.open_shared(key, self.fit, img_url, headers, limit)
+            filename = f"{os.path.splitext(filename)[0]}.{guess_extension(img)}"
+        return File(img, filename)
+
+    async def fetch_image(
+        self,
+        img_url: str,
+        filename: str,
+        headers: Optional[Dict[str, str]] = None,
+        limit: Optional[int] = None,
+        transcode: bool = True,
+    ) -> Union[File, str]:
+        """Like save_file, but returns the attachment URL instead
+        if the image has been uploaded before."""
+        if (url := await self.find_upload(img_url)) is not None:
+            return url
+        return await self.save_file(img_url, filename, headers, limit, transcode)
+
+    async def fetch_variant(
+        self,
+        ctx: CrosspostContext,
+        urls: Sequence[str],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[Union[File, str], str]:
+        """Fetch the best of urls, renditions of one image from largest to smallest,
+        that fits the upload limit. Only the last one is re-encoded to fit.
+
+        Guilds running low on bandwidth budget skip the largest rendition.
+        Returns what fetch_image does, along with the URL it came from."""
+        limit = self.get_upload_limit(ctx)
+        if ctx.guild is not None and self.economize(ctx.guild.id):
+            urls = urls[1:] or urls
+        for url in urls[:-1]:
+            # sizes of renditions found too large before
+            if (size := self.sizes.get(url)) is not None and size > limit:
+                continue
+            try:
+                file = await self.fetch_image(
+                    url, filename_of(url), headers, limit, transcode=False
+                )
+            except FileTooLarge:
+                continue
+            return file, url
+        url = urls[-1]
+        return await self.fetch_image(url, filename_of(url), headers, limit), url
+
+    async def find_upload(self, source: str) -> Optional[str]:
+        """Get the attachment URL an image was previously uploaded to, if any.
+        Remembered URLs are checked to still exist every upload_check_ttl."""
+        url = self.uploads.get(source, _missing)
+        if url is _missing:
+            flight = ("upload", source)
+            url = await self.inflight.do(flight, self.check_upload, source)
+        if url is not None:
+            self.metrics.incr("upload_reused", self.labels())
+        return url  # type: ignore
+
+    async def check_upload(self, source: str) -> Optional[str]:
+        async with self.bot.db.get_session() as s:
+            query = s.select(Upload).where(Upload.source == source)
+            row = await query.first()
+        url = None
+        if row is not None:
+            try:
+                async with get_(self.session, row.url, "HEAD"):
+                    url = row.url
+            except ResponseError as e:
+                if e.code in (403, 404):  # attachment deleted
+                    await self.forget_uploads([row.message_id])
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        self.uploads.set(source, url)
+        return url
+
+    async def record_upload(self, source: str, url: str, message: Message) -> None:
+        self.uploads.set(source, url)
+        async with self.bot.db.get_session() as s:
+            row = Upload(
+                source=source,
+                url=url,
+                channel_id=message.channel.id,
+                message_id=message.id,
+            )
+            query = s.insert.rows(row)
+            query = query.on_conflict(Upload.source).update(
+                getattr(Upload, name) for name in ("url", "channel_id", "message_id")
+            )
+            await query.run()
+
+    async def forget_uploads(self, message_ids: List[int]) -> None:
+        """Drop the attachments of deleted messages from the upload mapping."""
+        async with self.bot.db.get_session() as s:
+            for message_id in message_ids:
+                query = s.select(Upload).where(Upload.message_id == message_id)
+                async for row in await query.all():
+                    self.uploads.pop(row.source)
+                await s.delete(Upload).where(Upload.message_id == message_id)
+
+    async def fit(
+        self, img_url: str, headers: Optional[Dict[str, str]], limit: int
+    ) -> Path:
+        key = f"{img_url}#fit={limit}"
+        if (path := self.cache.get(key)) is not None:
+            return path
+        with await self.save(img_url, headers, self.transcode_max_size) as src:
+            try:
+                data = await self.run_transcoder(
+                    fit_image, src.name, limit, self.transcode_cpu
+                )
+            except Exception as e:  # undecodable image, timeout or dead worker
+                raise FileTooLarge(None, img_url) from e
+        if data is None:
+            raise FileTooLarge(None, img_url)
+        return await self.bot.loop.run_in_executor(
+            None, self.cache.put, key, BytesIO(data)
+        )
+
+    def new_transcoder(self) -> ProcessPoolExecutor:
+        # forking would copy the bot's threads and whatever locks they hold
+        method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(self.transcode_workers, get_context(method))
+
+    async def run_transcoder(self, func: Callable[..., T], *args: Any) -> T:
+        """Run func in the transcoder pool, replacing the pool if a worker died,
+        most likely killed for going over its CPU budget."""
+        pool = self.transcoder
+        try:
+            job = self.bot.loop.run_in_executor(pool, func, *args)
+            return await asyncio.wait_for(job, self.transcode_timeout)
+        except BrokenProcessPool:
+            if self.transcoder is pool and pool is not None:
+                pool.shutdown(wait=False)
+                self.transcoder = self.new_transcoder()
+            raise
+
+    async def process_links(
+        self,
+        ctx: CrosspostContext,
+        links: Optional[List[Tuple[int, str, str]]] = None,
+        dedupe: bool = False,
+    ) -> None:
+        if links is None:
+            links = self.find_links(ctx.message.content)
+        window = 0
+        if dedupe and ctx.guild is not None:
+            minutes = self.dedupe_windows.get(ctx.guild.id, 0)
+            window = min(minutes * 60, self.history_ttl)
+        for _, site, sub_id in links:
+            if site == "inkbunny":
+                # look submissions up together, before links wait for slots
+                self.bot.loop.create_task(
+                    self.prefetch(site, sub_id, self.inkbunny_batch.get, sub_id)
+                )
+        previous = None
+        tasks = []
+        for _, site, link in links:
+            link_ctx = ctx.fork(previous, self.link_tag(self.link_key(site, link)))
+            coro = self.process_link(link_ctx, site, link, window)
+            previous = self.bot.loop.create_task(coro)
+            tasks.append(previous)
+        if shed := (await asyncio.gather(*tasks)).count(False):
+            s = "s" if shed > 1 else ""
+            await ctx.send(
+                f"Skipped {shed} link{s}, too many are queued. Try again later."
+            )
+
+    async def process_link(
+        self, ctx: CrosspostContext, site: str, link: str, window: int = 0
+    ) -> bool:
+        """Crosspost a single link. If window is nonzero, links already crossposted
+        in the channel within the last window seconds get a jump link instead.
+
+        Finishes only after the links before it in the message, so that a link
+        sending nothing can't let later ones overtake earlier ones.
+        Returns False if the link was shed because its guild has too much queued."""
+        try:
+            processed = await self.crosspost_link(ctx, site, link, window)
+        finally:
+            ctx.release()
+        if ctx.previous is not None:
+            await asyncio.wait({ctx.previous})
+        return processed
+
+    async def crosspost_link(
+        self, ctx: CrosspostContext, site: str, link: str, window: int
+    ) -> bool:
+        func = self.link_funcs[site]
+        key = (ctx.channel.id, self.link_key(site, link))
+        current_site.set(site)
+        if window and (seen := self.history.get(key)) is not None:
+            message_id, time = seen
+            if (datetime.utcnow() - time).total_seconds() < window:
+                jump_url = f"https://discord.com/channels/{ctx.guild.id}/{ctx.channel.id}/{message_id}"  # type: ignore
+                await ctx.send(f"Already crossposted: {jump_url}")
+                return True
+        if ctx.guild is not None:
+            charged_guild.set(ctx.guild.id)
+        queue = ctx.channel.id if ctx.guild is None else ctx.guild.id
+        start = perf_counter()
+        try:
+            host = self.link_host(site, link)
+            ctx.lease = await self.scheduler.acquire(queue, host)
+        except QueueFull:
+            self.metrics.incr("shed", self.labels())
+            return False
+        labels = self.labels()
+        waited = perf_counter() - start
+        self.metrics.observe("queue_wait", labels, waited)
+        # time spent queued doesn't count against the link's deadline,
+        # nor against the deadline of the command it's part of
+        extend_deadline(waited)
+        set_deadline(self.link_timeout)
+        try:
+            await func(link, ctx)
+            await ctx.flush()
+        except Exception as e:
+            self.metrics.incr("errors", labels)
+            if isinstance(e, ResponseError):
+                self.metrics.incr(f"http_{e.code}", labels)
+            await ctx.bot.handle_error(ctx, e)
+        else:
+            self.metrics.observe("link_time", labels, perf_counter() - start)
+            if window and (reply := ctx.first_post) is not None:
+                await self.record_history(key, reply)
+        return True
+
+    @classmethod
+    def link_key(cls, site: str, link: str) -> str:
+        """Identify the post a link is to, however the link is written."""
+        link = link.strip().rstrip(">")
+        if (expr := cls.post_id_exprs.get(site)) is not None:
+            if match := expr.search(link):
+                return f"{site}:{'/'.join(filter(None, match.groups()))}"
+        return f"{site}:{cls.scheme_expr.sub('', link)}"
+
+    @staticmethod
+    def link_tag(key: str) -> int:
+        """A tag for the replies to a link in sent_images."""
+        return hash(key) & 0xFFFF_FFFF_FFFF_FFFF
+
+    @staticmethod
+    def labels() -> List[str]:
+        """Metric labels for the link being handled."""
+        labels = [f"site:{current_site.get()}"]
+        if (guild_id := charged_guild.get()) is not None:
+            labels.append(f"guild:{guild_id}")
+        return labels
+
+    @staticmethod
+    def link_host(site: str, link: str) -> str:
+        """The host work for a link is limited by. Mastodon links are limited
+        per instance, other sites as a whole."""
+        if site == "mastodon":
+            return urlsplit(link).hostname or site
+        return site
+
+    async def record_history(self, key: Tuple[int, str], reply: Message) -> None:
+        channel_id, post = key
+        time = reply.created_at
+        self.history.set(key, (reply.id, time))
+        async with self.bot.db.get_session() as s:
+            row = History(
+                channel_id=channel_id,
+                post=post,
+                guild_id=reply.guild.id,  # type: ignore
+                message_id=reply.id,
+                time=time,
+            )
+            query = s.insert.rows(row)
+            query = query.on_conflict(History.channel_id, History.post).update(
+                getattr(History, name) for name in ("guild_id", "message_id", "time")
+            )
+            await query.run()
+
+    async def forget_history(self, message_ids: List[int]) -> None:
+        """Stop pointing repeated links to crossposts that were deleted."""
+        async with self.bot.db.get_session() as s:
+            for message_id in message_ids:
+                query = s.select(History).where(History.message_id == message_id)
+                async for row in await query.all():
+                    self.history.pop((row.channel_id, row.post))
+                await s.delete(History).where(History.message_id == message_id)
 
     @Cog.listener()
     async def on_message(self, message: Message) -> None:
         if (guild := message.guild) is None or message.author.bot:
             return
+        if not (links := self.find_links(message.content)):
+            return
         if not guild.me.permissions_in(message.channel).send_messages:  # type: ignore
             return
         if not (await self.bot.config.get_guild(guild.id)).get("crosspost_enabled"):
             return
-        if "http" not in message.content:
-            return
 
         ctx = await self.bot.get_context(message, cls=CrosspostContext)
         if ctx.command is None:
             ctx.command = self.post
-            await self.process_links(ctx)
+            await self.process_links(ctx, links, dedupe=True)
 
     @Cog.listener()
-    async def on_message_delete(self, message: Message) -> None:
-        for msg in self.sent_images[message.id]:
-            await msg.delete()
-        del self.sent_images[message.id]
+    async def on_message_edit(self, before: Message, after: Message) -> None:
+        if before.content == after.content:  # e.g. Discord adding embeds
+            return
+        if (guild := after.guild) is None or after.author.bot:
+            return
+        old = {
+            self.link_key(site, link)
+            for _, site, link in self.find_links(before.content)
+        }
+        links = self.find_links(after.content)
+        new = {self.link_key(site, link) for _, site, link in links}
+        if removed := old - new:
+            tags = {self.link_tag(key) for key in removed}
+            await self.delete_replies(self.sent_images.remove(after.id, tags))
+        added = [
+            (pos, site, link)
+            for pos, site, link in links
+            if self.link_key(site, link) not in old
+        ]
+        if not added:
+            return
+        if not guild.me.permissions_in(after.channel).send_messages:  # type: ignore
+            return
+        if not (await self.bot.config.get_guild(guild.id)).get("crosspost_enabled"):
+            return
+
+        ctx = await self.bot.get_context(after, cls=CrosspostContext)
+        if ctx.command is None:
+            ctx.command = self.post
+            await self.process_links(ctx, added, dedupe=True)
 
-    async def send(self, ctx: CrosspostContext, link: str) -> None:
+    @Cog.listener()
+    async def on_message_delete(self, message: Message) -> None:
+        if message.author == self.bot.user:
+            if message.attachments:
+                await self.forget_uploads([message.id])
+            await self.forget_history([message.id])
+            return
+        await self.delete_replies(self.sent_images.pop(message.id))
+
+    async def delete_replies(self, replies: List[Tuple[int, int]]) -> None:
+        """Delete the given (channel_id, message_id) pairs of crosspost replies."""
+        channels: Dict[int, List[int]] = defaultdict(list)
+        for channel_id, message_id in replies:
+            channels[channel_id].append(message_id)
+        if channels:
+            deleted = [message_id for ids in channels.values() for message_id in ids]
+            await self.forget_uploads(deleted)
+            await self.forget_history(deleted)
+        for channel_id, message_ids in channels.items():
+            channel = self.bot.get_channel(channel_id)
+            if (
+                isinstance(channel, TextChannel)
+                and channel.permissions_for(channel.guild.me).manage_messages
+            ):
+                # bulk delete takes between 2 and 100 messages
+                while len(message_ids) > 1:
+                    chunk = [Object(message_id) for message_id in message_ids[:100]]
+                    del message_ids[:100]
+                    await channel.delete_messages(chunk)
+            for message_id in message_ids:
+                try:
+                    await self.bot.http.delete_message(channel_id, message_id)
+                except NotFound:
+                    pass
+
+    async def send(self, ctx: CrosspostContext, link: str, *smaller: str) -> None:
+        """Crosspost the image at link, or one of the smaller renditions
+        of it if it's too large to upload."""
+        await self.deliver(ctx, *await self.prepare(ctx, link, *smaller))
+
+    async def prepare(
+        self, ctx: CrosspostContext, link: str, *smaller: str
+    ) -> Tuple[str, Optional[Tuple[Union[File, str], str]]]:
+        """Fetch what send would upload for link, returned along with the link.
+        None is returned instead if the link should be posted as is."""
         mode = await self.get_mode(ctx)
         if mode == 1:
-            await ctx.send(link)
+            return link, None
         elif mode == 2:
-            img = await self.save(link)
-            filename = re.findall(r"[\w. -]+\.[\w. -]+", link)[-1]
-            file = File(img, filename)
-            await ctx.send(file=file)
+            try:
+                return link, await self.fetch_variant(ctx, (link, *smaller))
+            except FileTooLarge:
+                return link, None
         else:
             raise RuntimeError("Invalid crosspost mode!")
 
+    async def deliver(
+        self,
+        ctx: CrosspostContext,
+        link: str,
+        prepared: Optional[Tuple[Union[File, str], str]],
+    ) -> None:
+        if prepared is None:
+            await ctx.send_post(link)
+        else:
+            await ctx.send_file(*prepared)
+
+    @staticmethod
+    def discard(
+        result: Optional[Tuple[str, Optional[Tuple[Union[File, str], str]]]]
+    ) -> None:
+        """Close the file of a prepared image that won't be delivered."""
+        if result is not None and (prepared := result[1]) is not None:
+            if isinstance(file := prepared[0], File):
+                file.close()
+
+    async def get_embeds(self, message: Message, key: str) -> Optional[List[Embed]]:
+        """Get the embeds Discord unfurled a link into, identified by key being in
+        their URL. Waits up to embed_wait seconds for Discord to add embeds
+        to a message without any. Returns None if no embed matches."""
+        if not self.embed_wait:
+            return None
+        if not message.embeds:
+
+            def check(before: Message, after: Message) -> bool:
+                return after.id == message.id and bool(after.embeds)
+
+            try:
+                _, message = await self.bot.wait_for(
+                    "message_edit", check=check, timeout=self.embed_wait
+                )
+            except asyncio.TimeoutError:
+                return None
+        embeds = [
+            embed
+            for embed in message.embeds
+            if isinstance(embed.url, str) and key in embed.url
+        ]
+        return embeds or None
+
+    async def lookup(
+        self,
+        site: str,
+        key: str,
+        resolve: Callable[..., Awaitable[Optional[Post]]],
+        *args: Any,
+    ) -> Optional[Post]:
+        """Get a post's metadata from the cache, resolving it on a miss.
+        A post that resolves to None is cached for post_negative_ttl."""
+        post = self.posts.get((site, key), _missing)
+        if post is not _missing:
+            self.metrics.incr("post_cache_hit", self.labels())
+        else:
+            self.metrics.incr("post_cache_miss", self.labels())
+            flight = ("post", site, key)
+            post = await self.inflight.do(
+                flight, self.resolve, site, key, resolve, *args
+            )
+        return post  # type: ignore
+
+    async def prefetch(
+        self,
+        site: str,
+        key: str,
+        resolve: Callable[..., Awaitable[Optional[Post]]],
+        *args: Any,
+    ) -> None:
+        """Look up a post ahead of handling its link."""
+        current_site.set(site)
+        try:
+            await self.lookup(site, key, resolve, *args)
+        except Exception:
+            pass  # reported when the link itself looks the post up
+
+    async def resolve(
+        self,
+        site: str,
+        key: str,
+        resolve: Callable[..., Awaitable[Optional[Post]]],
+        *args: Any,
+    ) -> Optional[Post]:
+        start = perf_counter()
+        post = await resolve(*args)
+        self.metrics.observe("resolve_time", self.labels(), perf_counter() - start)
+        ttl = self.post_ttl if post is not None else self.post_negative_ttl
+        self.posts.set((site, key), post, ttl)
+        return post
+
     async def get_mode(self, ctx: BContext) -> int:
-        if ctx.guild is None:
+        if ctx.guild is None or self.over_budget(ctx.guild.id):
             return 1
         return (await ctx.bot.config.get_guild(ctx.guild.id)).get("crosspost_mode") or 1
 
+    def get_budget(self, guild_id: int) -> int:
+        return self.guild_budgets.get(guild_id, self.budget)
+
+    def economize(self, guild_id: int) -> bool:
+        """Whether a guild has used enough of its bandwidth budget
+        that smaller renditions of images should be preferred."""
+        used = self.usage.total(guild_id)
+        return used >= self.get_budget(guild_id) * self.budget_economy
+
+    def over_budget(self, guild_id: int) -> bool:
+        """Whether a guild has used up its bandwidth budget for now,
+        in which case it's served in link mode."""
+        return self.usage.total(guild_id) >= self.get_budget(guild_id)
+
+    def get_upload_limit(self, ctx: BContext) -> int:
+        if ctx.guild is None:
+            return 8_000_000
+        return ctx.guild.filesize_limit
+
     async def get_max_pages(self, ctx: BContext) -> int:
         if ctx.guild is None:
             return 4
@@ -234,22 +1100,54 @@ class Crosspost(Cog):
         if await self.get_mode(ctx) == 1:
             return
 
+        tweet_id = link.rpartition("/")[2]
         link = f"https://{link}"
 
+        post = await self.lookup(
+            "twitter", tweet_id, self.resolve_twitter, link, ctx.message
+        )
+        if post is None:
+            await ctx.send("Failed to get tweet. Maybe the account is locked?")
+            return
+
+        for url in post.urls:
+            await self.send(ctx, f"{url}:orig", f"{url}:large")
+
+    async def resolve_twitter(self, link: str, message: Message) -> Optional[Post]:
+        status = link[link.index("/status/") :]
+        if (embeds := await self.get_embeds(message, status)) is not None:
+            return Post(
+                [
+                    self.twitter_media_url(embed.image.url)
+                    for embed in embeds
+                    if embed.image.url and not embed.video.url
+                ]
+            )
+
         async with self.get(link) as resp:
-            root = etree.fromstring(await resp.read(), self.parser)
+            root = await parse_html(resp, self.is_tweet)
 
         try:
             tweet = root.xpath(self.tweet_selector)[0]
         except IndexError:
-            await ctx.send("Failed to get tweet. Maybe the account is locked?")
-            return
+            return None
 
-        for img in tweet.xpath(self.twitter_img_selector):
-            url = img.get("src")
-            await self.send(ctx, f"{url}:orig")
+        return Post([img.get("src") for img in tweet.xpath(self.twitter_img_selector)])
+
+    @staticmethod
+    def twitter_media_url(url: str) -> str:
+        """Convert an embedded image URL to the form the tweet page uses,
+        without a size suffix or query."""
+        parts = urlsplit(url)
+        path = parts.path.partition(":")[0]
+        if "." not in path.rpartition("/")[2]:
+            fmt = parse_qs(parts.query).get("format", ["jpg"])[0]
+            path = f"{path}.{fmt}"
+        return f"{parts.scheme}://{parts.netloc}{path}"
 
     async def display_pixiv_images(self, link: str, ctx: CrosspostContext) -> None:
+        if ctx.guild is not None and self.over_budget(ctx.guild.id):
+            return
         if "mode" in link:
             link = re.sub(r"(?<=mode=)\w+", "medium", link)
         elif "illust_id" in link:
@@ -260,61 +1158,78 @@ class Crosspost(Cog):
         else:
             await ctx.send("Failed to find illust ID in pixiv link. This is a bug.")
             return
-        headers = {
-            "App-OS": "ios",
-            "App-OS-Version": "10.3.1",
-            "App-Version": "6.7.1",
-            "User-Agent": "PixivIOSApp/6.7.1 (ios 10.3.1; iPhone8,1)",
-            "Authorization": self.headers["Authorization"],
-        }
-        params = {"illust_id": illust_id}
-        url = "https://app-api.pixiv.net/v1/illust/detail"
-        async with self.session.get(url, params=params, headers=headers) as resp:
-            res = await resp.json()
         try:
-            res = res["illust"]
-        except KeyError:
+            post = await self.lookup("pixiv", illust_id, self.resolve_pixiv, illust_id)
+        except ResolveError as e:
             await ctx.send(
-                f"This feature works sometimes, but isn't working right now!\nDebug info:\n{res.get('error')}"
+                f"This feature works sometimes, but isn't working right now!\nDebug info:\n{e}"
             )
             return
+        if post is None:
+            await ctx.send("Failed to get pixiv post. Maybe it was deleted?")
+            return
 
-        if single := res["meta_single_page"]:
-            img_url = single["original_image_url"]
+        headers = self.pixiv_headers()
+        if len(post.urls) == 1:
+            img_url = post.urls[0]
             if "ugoira" in img_url:
+                source = f"ugoira:{illust_id}"
                 try:
-                    file = await self.get_ugoira(link)
-                except ResponseError:
+                    file = await self.get_ugoira(illust_id, self.get_upload_limit(ctx))
+                except FileTooLarge:
+                    await ctx.send("Image too large to upload.")
+                    return
+                except (
+                    ResponseError,
+                    ResolveError,
+                    asyncio.TimeoutError,
+                    BrokenProcessPool,
+                ):
                     await ctx.send("Ugoira machine :b:roke")
                     return
             else:
                 headers["referer"] = link
-                img = await self.save(img_url, headers)
-                file = File(img, img_url.rpartition("/")[-1])
-            await ctx.send(file=file)
-        elif multi := res["meta_pages"]:
+                if post.variants:
+                    renditions = (img_url, *post.variants[0])
+                else:
+                    renditions = (img_url,)
+                try:
+                    file, source = await self.fetch_variant(ctx, renditions, headers)
+                except FileTooLarge:
+                    await ctx.send("Image too large to upload.")
+                    return
+            await ctx.send_file(file, source)
+        elif post.urls:
             # multi_image_post
-            urls = (page["image_urls"]["original"] for page in multi)
+            urls = post.urls
 
             max_pages = await self.get_max_pages(ctx)
-            num_pages = len(multi)
+            num_pages = len(urls)
 
             if max_pages == 0:
                 max_pages = num_pages
 
-            tasks = []
+            tasks: List[asyncio.Task[Tuple[Union[File, str], str]]] = []
 
             for img_url, i in zip(urls, range(max_pages)):
                 fullsize_url = f"https://pixiv.net/member_illust.php?mode=manga_big&illust_id={illust_id}&page={i}"
-                headers["referer"] = fullsize_url
-                task = self.bot.loop.create_task(self.save(img_url, headers))
-                filename = img_url.rpartition("/")[-1]
-                tasks.append((filename, task))
-
-            for filename, task in tasks:
-                img = await task
-                file = File(img, filename)
-                await ctx.send(file=file)
+                headers = {**headers, "referer": fullsize_url}
+                if i < len(post.variants):
+                    renditions = (img_url, *post.variants[i])
+                else:
+                    renditions = (img_url,)
+                task = self.bot.loop.create_task(
+                    self.fetch_variant(ctx, renditions, headers)
+                )
+                tasks.append(task)
+
+            for task in tasks:
+                try:
+                    file, source = await task
+                except FileTooLarge:
+                    await ctx.send("Image too large to upload.")
+                    continue
+                await ctx.send_file(file, source)
 
             remaining = num_pages - max_pages
 
@@ -323,19 +1238,78 @@ class Crosspost(Cog):
                 message = f"{remaining} more image{s} at <https://www.pixiv.net/en/artworks/{illust_id}>"
                 await ctx.send(message)
 
-    async def get_ugoira(self, link: str, fmt: str = "gif") -> File:
-        params = {"url": link, "format": fmt}
-        conv_url = "http://ugoira.dataprocessingclub.org/convert"
-        async with self.get(conv_url, params=params, timeout=None) as resp:
-            text = await resp.text()
-        url = json.loads(text)["url"]
-        img = await self.save(url)
-        name = url.rpartition("/")[2]
-        return File(img, name)
+    def pixiv_headers(self) -> Dict[str, str]:
+        return {
+            "App-OS": "ios",
+            "App-OS-Version": "10.3.1",
+            "App-Version": "6.7.1",
+            "User-Agent": "PixivIOSApp/6.7.1 (ios 10.3.1; iPhone8,1)",
+            "Authorization": self.headers["Authorization"],
+        }
+
+    async def resolve_pixiv(self, illust_id: str) -> Optional[Post]:
+        headers = self.pixiv_headers()
+        params = {"illust_id": illust_id}
+        url = "https://app-api.pixiv.net/v1/illust/detail"
+        async with self.session.get(url, params=params, headers=headers) as resp:
+            res = await resp.json()
+            status = resp.status
+        try:
+            res = res["illust"]
+        except KeyError:
+            if status == 404:
+                return None
+            raise ResolveError(res.get("error"))
+
+        sensitive = res.get("x_restrict", 0) > 0
+        if single := res["meta_single_page"]:
+            image_urls = res["image_urls"]
+            smaller = (image_urls["large"], image_urls["medium"])
+            return Post([single["original_image_url"]], sensitive, variants=(smaller,))
+        pages = [page["image_urls"] for page in res["meta_pages"]]
+        urls = [page["original"] for page in pages]
+        variants = tuple((page["large"], page["medium"]) for page in pages)
+        return Post(urls, sensitive, variants=variants)
+
+    async def get_ugoira(self, illust_id: str, limit: int) -> Union[File, str]:
+        if (url := await self.find_upload(f"ugoira:{illust_id}")) is not None:
+            return url
+        key = f"ugoira:{illust_id}#fit={limit}"
+        if (fp := self.cache.open(key)) is None:
+            flight = ("ugoira", illust_id, limit)
+            fp = await self.open_shared(
+                flight, self.convert_ugoira, illust_id, key, limit
+            )
+        return File(fp, f"{illust_id}.gif")
+
+    async def convert_ugoira(self, illust_id: str, key: str, limit: int) -> Path:
+        if self.transcoder is None:
+            raise ResolveError("Pillow is not installed")
+        headers = self.pixiv_headers()
+        params = {"illust_id": illust_id}
+        url = "https://app-api.pixiv.net/v1/ugoira/metadata"
+        async with self.get(url, params=params, headers=headers) as resp:
+            res = await resp.json()
+        try:
+            res = res["ugoira_metadata"]
+        except KeyError:
+            raise ResolveError(res.get("error")) from None
+        zip_url = res["zip_urls"]["medium"]
+        frames = [(frame["file"], frame["delay"]) for frame in res["frames"]]
+        headers["referer"] = "https://www.pixiv.net/"
+        with await self.save(zip_url, headers, self.transcode_max_size) as src:
+            data = await self.run_transcoder(
+                make_gif, src.name, frames, limit, self.transcode_cpu
+            )
+        if data is None:
+            raise FileTooLarge(None, zip_url)
+        return await self.bot.loop.run_in_executor(
+            None, self.cache.put, key, BytesIO(data)
+        )
 
     async def display_hiccears_images(self, link: str, ctx: CrosspostContext) -> None:
         async with self.get(link) as resp:
-            root = etree.fromstring(await resp.read(), self.parser)
+            root = await parse_html(resp, self.is_hiccears_img)
 
         if single_image := root.xpath(self.hiccears_img_selector):
             a = single_image[0]
@@ -353,35 +1327,43 @@ class Crosspost(Cog):
 
         pages_remaining = num_images - max_pages
         images = images[:max_pages]
-        for image in images:
-            href = image.get("href")
-            url = f"https://{resp.host}{href[1:]}"
-            async with self.get(url) as page_resp:
-                page = etree.fromstring(await page_resp.read(), self.parser)
-            try:
-                a = page.xpath(self.hiccears_img_selector)[0]
-            except IndexError:
-                # hit a premium gallery teaser thumbnail
-                return
-            href = a.get("href")[1:]  # trim leading '.'
-            url = f"https://{resp.host}{href}"
-            await self.send(ctx, url)
+        host = resp.host
+        pages = (self.expand_hiccears(ctx, host, image.get("href")) for image in images)
+        slots = self.gallery_slots[host]
+        async with ordered(pages, slots, self.discard) as results:
+            async for result in results:
+                if result is None:
+                    # hit a premium gallery teaser thumbnail
+                    return
+                await self.deliver(ctx, *result)
         if pages_remaining > 0:
             s = "s" if pages_remaining > 1 else ""
             message = f"{pages_remaining} more image{s} at <{link}>"
             await ctx.send(message)
 
+    async def expand_hiccears(
+        self, ctx: CrosspostContext, host: str, href: str
+    ) -> Optional[Tuple[str, Optional[Tuple[Union[File, str], str]]]]:
+        """Find the image on a gallery page and prepare it,
+        or return None if the page is a premium teaser."""
+        url = f"https://{host}{href[1:]}"
+        async with self.get(url) as page_resp:
+            page = await parse_html(page_resp, self.is_hiccears_img)
+        try:
+            a = page.xpath(self.hiccears_img_selector)[0]
+        except IndexError:
+            return None
+        href = a.get("href")[1:]  # trim leading '.'
+        url = f"https://{host}{href}"
+        return await self.prepare(ctx, url)
+
     async def display_tumblr_images(self, link: str, ctx: CrosspostContext) -> None:
-        idx = 1
-        async with self.get(link) as resp:
-            root = etree.fromstring(await resp.read(), self.parser)
-        if not str(resp.url).startswith(link):  # explicit blog redirect
-            async with self.bot.session.get(
-                link
-            ) as resp:  # somehow this doesn't get redirected?
-                root = etree.fromstring(await resp.read(), self.parser)
-            idx = 0
-        images = root.xpath(self.tumblr_img_selector)
+        post = await self.lookup("tumblr", link, self.resolve_tumblr, link)
+        if post is None:
+            await ctx.send("Failed to get tumblr post.")
+            return
+        idx = post.skip
+        images = post.urls
         mode = await self.get_mode(ctx)
         max_pages = await self.get_max_pages(ctx)
 
@@ -394,46 +1376,131 @@ class Crosspost(Cog):
 
         images = images[idx:max_pages]
 
-        for image in images:
-            url = image.get("content")
-            await self.send(ctx, url)
+        if images:
+            slots = self.gallery_slots[urlsplit(images[0]).hostname or "tumblr"]
+            prepared = (self.prepare(ctx, url) for url in images)
+            async with ordered(prepared, slots, self.discard) as results:
+                async for result in results:
+                    await self.deliver(ctx, *result)
         if mode == 1 and pages_remaining > 0:
             s = "s" if pages_remaining > 1 else ""
             message = f"{pages_remaining} more image{s} at <{link}>"
             await ctx.send(message)
 
+    async def resolve_tumblr(self, link: str) -> Optional[Post]:
+        idx = 1
+        try:
+            async with self.get(link) as resp:
+                root = await parse_html(resp, self.is_head)
+        except ResponseError as e:
+            if e.code == 404:  # deleted
+                return None
+            raise
+        if not str(resp.url).startswith(link):  # explicit blog redirect
+            async with self.bot.session.get(
+                link
+            ) as resp:  # somehow this doesn't get redirected?
+                root = await parse_html(resp, self.is_head)
+            idx = 0
+        images = root.xpath(self.tumblr_img_selector)
+        return Post([image.get("content") for image in images], skip=idx)
+
+    async def is_mastodon(self, host: str) -> bool:
+        if host in self.mastodon_allowlist:
+            return True
+        if (known := self.mastodon_hosts.get(host)) is not None:
+            return known
+        if not self.mastodon_probe or not self.is_public_host(host):
+            return False
+        return await self.inflight.do(("mastodon", host), self.probe_mastodon, host)
+
+    @classmethod
+    def is_public_host(cls, host: str) -> bool:
+        """Whether host could be a public instance, and so is safe to probe."""
+        if cls.mastodon_host_expr.fullmatch(host) is None:
+            return False
+        return host.rpartition(".")[2].lower() not in cls.local_tlds
+
+    async def probe_mastodon(self, host: str) -> bool:
+        url = self.mastodon_instance_fmt.format(host)
+        timeout = aiohttp.ClientTimeout(total=10)
+        try:
+            # not self.get, so the cog's credentials aren't sent to arbitrary hosts
+            async with get_(self.session, url, timeout=timeout) as resp:
+                instance = await resp.json()
+        except (ResponseError, aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            instance = None
+        found = isinstance(instance, dict) and "uri" in instance
+        ttl = None if found else self.mastodon_negative_ttl
+        self.mastodon_hosts.set(host, found, ttl)
+        return found
+
     async def display_mastodon_images(self, link: str, ctx: CrosspostContext) -> None:
         if (match := self.mastodon_url_groups.match(link)) is None:
             return
-        api_url = self.mastodon_api_fmt.format(*match.groups())
-        try:
-            async with self.session.get(api_url) as resp:
-                post = await resp.json()
-        except (ResponseError, aiohttp.ContentTypeError):
+        host, status_id = match.groups()
+        if not await self.is_mastodon(host):
             return
+        key = f"{host}/{status_id}"
+        post = await self.lookup(
+            "mastodon", key, self.resolve_mastodon, host, status_id
+        )
 
-        if not (images := post.get("media_attachments")):
+        if post is None or not post.urls:
             return
 
         mode = await self.get_mode(ctx)
 
-        idx = 0 if mode != 1 or post["sensitive"] else 1
+        idx = 0 if mode != 1 or post.sensitive else 1
 
-        for image in images[idx:]:
-            url = image["remote_url"] or image["url"]
+        for url in post.urls[idx:]:
             await self.send(ctx, url)
 
+    async def resolve_mastodon(self, host: str, status_id: str) -> Optional[Post]:
+        api_url = self.mastodon_api_fmt.format(host, status_id)
+        try:
+            async with self.session.get(api_url) as resp:
+                post = await resp.json()
+        except (ResponseError, aiohttp.ContentTypeError):
+            return None
+
+        if not isinstance(post, dict) or "error" in post:
+            return None
+
+        images = post.get("media_attachments") or []
+        urls = [image["remote_url"] or image["url"] for image in images]
+        return Post(urls, post.get("sensitive", False))
+
     async def display_inkbunny_images(self, sub_id: str, ctx: CrosspostContext) -> None:
+        post = await self.lookup("inkbunny", sub_id, self.inkbunny_batch.get, sub_id)
+        if post is None:
+            return
+
+        for url in post.urls:
+            await self.send(ctx, url)
+
+    async def resolve_inkbunny(self, sub_ids: List[str]) -> Dict[str, Post]:
         url = self.inkbunny_api_fmt.format("submissions")
-        params = {"sid": self.inkbunny_sid, "submission_ids": sub_id}
-        async with self.get(url, "POST", params=params) as resp:
-            response = await resp.json()
+        for _ in range(2):
+            params = {"sid": self.inkbunny_sid, "submission_ids": ",".join(sub_ids)}
+            async with self.get(url, "POST", params=params) as resp:
+                response = await resp.json()
+            if response.get("error_code") != 2:  # invalid session ID
+                break
+            await self.inflight.do(("inkbunny", "login"), self.inkbunny_login)
 
-        sub = response["submissions"][0]
+        try:
+            subs = response["submissions"]
+        except KeyError:
+            raise ResolveError(response.get("error_message")) from None
 
-        for file in sub["files"]:
-            url = file["file_url_full"]
-            await self.send(ctx, url)
+        return {
+            sub["submission_id"]: Post(
+                [file["file_url_full"] for file in sub["files"]],
+                sub["rating_id"] != "0",
+            )
+            for sub in subs
+        }
 
     @commands.command(hidden=True)
     @is_owner_or(manage_guild=True)
@@ -483,6 +1550,81 @@ class Crosspost(Cog):
         await self.bot.config.set_guild(guild_id, crosspost_max_pages=max_pages)
         await ctx.send(f"Max crosspost pages set to {max_pages}")
 
+    @crosspost.command()
+    async def dedupe(self, ctx: BContext, minutes: int) -> None:
+        """Link to the earlier crosspost instead of reposting links
+        seen in the channel within the given number of minutes.
+
+        Set to 0 to disable."""
+        guild_id = ctx.guild.id  # type: ignore
+        if minutes:
+            self.dedupe_windows[guild_id] = minutes
+        else:
+            self.dedupe_windows.pop(guild_id, None)
+        async with self.bot.db.get_session() as s:
+            query = s.insert.rows(Settings(guild_id=guild_id, dedupe=minutes))
+            query = query.on_conflict(Settings.guild_id).update([Settings.dedupe])
+            await query.run()
+        if minutes:
+            await ctx.send(f"Repeated links within {minutes} minutes will be linked.")
+        else:
+            await ctx.send("Repeated links will be crossposted again.")
+
+    @crosspost.command()
+    async def stats(self, ctx: BContext) -> None:
+        """Show how much of this server's crosspost bandwidth budget is used."""
+        guild_id = ctx.guild.id  # type: ignore
+        used = self.usage.total(guild_id)
+        budget = self.get_budget(guild_id)
+        hours = self.usage.width * self.usage.buckets / 3600
+        message = f"{used / 1e6:.1f} of {budget / 1e6:.1f} MB used"
+        message = f"{message} in the last {hours:g} hours."
+        if self.over_budget(guild_id):
+            message = f"{message}\nImages are linked until usage drops."
+        await ctx.send(message)
+
+    @crosspost.command(hidden=True)
+    @commands.is_owner()
+    async def queue(self, ctx: BContext) -> None:
+        """Show crosspost scheduler statistics."""
+        sched = self.scheduler
+        average = sched.wait_total / sched.started if sched.started else 0.0
+        await ctx.send(
+            f"{sched.running} running, {len(sched)} queued "
+            f"for {len(sched.queues)} guilds, {sched.shed} shed\n"
+            f"Queue wait: {average:.2f}s average, {sched.wait_max:.2f}s max "
+            f"over {sched.started} links"
+        )
+
+    @crosspost.command(name="metrics", hidden=True)
+    @commands.is_owner()
+    async def show_metrics(self, ctx: BContext, label: str = "site:") -> None:
+        """Show crosspost metrics for labels starting with label,
+        or all of them as JSON if label is "json"."""
+        dump = self.metrics.dump()
+        if label == "json":
+            data = json.dumps(dump, indent=2).encode()
+            await ctx.send(file=File(BytesIO(data), "metrics.json"))
+            return
+        lines = []
+        for name, histograms in sorted(dump["histograms"].items()):
+            for key, hist in sorted(histograms.items()):
+                if key.startswith(label):
+                    lines.append(
+                        f"{name} {key}: n={hist['count']} p50={hist['p50']:.3g} "
+                        f"p90={hist['p90']:.3g} p99={hist['p99']:.3g} "
+                        f"max={hist['max']:.3g}"
+                    )
+        for name, counter in sorted(dump["counters"].items()):
+            for key, count in sorted(counter.items()):
+                if key.startswith(label):
+                    lines.append(f"{name} {key}: {count}")
+        text = "\n".join(lines) or "No metrics recorded."
+        if len(text) > 1990:
+            await ctx.send(file=File(BytesIO(text.encode()), "metrics.txt"))
+        else:
+            await ctx.send(f"```\n{text}```")
+
     @commands.command()
     async def post(self, ctx: BContext, *, _: str) -> None:
         """Embed images in the given links regardles of the global embed setting."""
@@ -490,5 +1632,13 @@ class Crosspost(Cog):
         await self.process_links(new_ctx)
 
 
+_missing = object()
+
+# the guild whose crosspost is being handled, charged for the bytes moved
+charged_guild: ContextVar[Optional[int]] = ContextVar("charged_guild", default=None)
+# the site of the link being handled, for metrics
+current_site: ContextVar[str] = ContextVar("current_site", default="other")
+
+
 def setup(bot: BeattieBot) -> None:
     bot.add_cog(Crosspost(bot))
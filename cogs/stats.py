@@ -68,6 +68,22 @@ class Stats(Cog):
         embed.add_field(name="Memory Usage", value=f"{memory_usage:.2f} MiB")
         await ctx.send(embed=embed)
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def connections(self, ctx: BContext) -> None:
+        """Show HTTP connection reuse per host."""
+        stats = ctx.bot.transport.stats.dump()
+        lines = [
+            f"{host}: {host_stats['requests']} requests, "
+            f"{host_stats['created']} new connections, "
+            f"{host_stats['reused']} reused, "
+            f"{host_stats['dns_misses']} DNS lookups"
+            for host, host_stats in sorted(
+                stats.items(), key=lambda item: -item[1]["requests"]
+            )
+        ]
+        await ctx.send("\n".join(lines[:20]) or "No requests made yet.")
+
     def get_bot_uptime(self, bot: BeattieBot, brief: bool = False) -> str:
         now = datetime.datetime.utcnow()
         try:
@@ -0,0 +1,25 @@
+from asyncqlio.orm.schema.column import Column
+from asyncqlio.orm.schema.table import table_base
+from asyncqlio.orm.schema.types import BigInt, Integer, Text, Timestamp
+
+Table = table_base()
+
+
+class History(Table, table_name="crosspost_history"):  # type: ignore
+    channel_id = Column(BigInt, primary_key=True)
+    post = Column(Text, primary_key=True)
+    guild_id = Column(BigInt)
+    message_id = Column(BigInt)
+    time = Column(Timestamp)
+
+
+class Settings(Table, table_name="crosspost_settings"):  # type: ignore
+    guild_id = Column(BigInt, primary_key=True)
+    dedupe = Column(Integer, nullable=True)
+
+
+class Upload(Table, table_name="crosspost_uploads"):  # type: ignore
+    source = Column(Text, primary_key=True)
+    url = Column(Text)
+    channel_id = Column(BigInt)
+    message_id = Column(BigInt)
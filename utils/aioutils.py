@@ -1,5 +1,28 @@
 import asyncio
-from typing import Any, Awaitable, Callable
+from collections import Counter, OrderedDict, deque
+from time import monotonic
+from types import TracebackType
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .exceptions import QueueFull
+
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
 
 
 def do_every(
@@ -11,3 +34,256 @@ def do_every(
             await coro(*args, **kwargs)
 
     return asyncio.get_event_loop().create_task(task())
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single call.
+
+    Every caller waiting on a key receives the result of the same call.
+    Cancelling a caller does not cancel the shared call."""
+
+    def __init__(self) -> None:
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.calls
+
+    async def do(
+        self, key: Hashable, func: Callable[..., Awaitable[T]], *args: Any
+    ) -> T:
+        if (fut := self.calls.get(key)) is None:
+            fut = asyncio.ensure_future(func(*args))
+            self.calls[key] = fut
+
+            def done(_: asyncio.Future) -> None:
+                if self.calls.get(key) is fut:
+                    del self.calls[key]
+
+            fut.add_done_callback(done)
+        return await asyncio.shield(fut)
+
+
+class Batcher(Generic[K, V]):
+    """Gathers keys requested within delay seconds of each other
+    and resolves them with a single call to func.
+
+    func receives up to maxsize keys and returns a mapping of results.
+    Keys missing from the mapping resolve to None."""
+
+    def __init__(
+        self,
+        func: Callable[[List[K]], Awaitable[Dict[K, V]]],
+        delay: float,
+        maxsize: int,
+    ):
+        self.func = func
+        self.delay = delay
+        self.maxsize = maxsize
+        self.pending: Dict[K, asyncio.Future] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    async def get(self, key: K) -> Optional[V]:
+        if (fut := self.pending.get(key)) is None:
+            loop = asyncio.get_event_loop()
+            fut = self.pending[key] = loop.create_future()
+            if len(self.pending) >= self.maxsize:
+                self.flush()
+            elif self.timer is None:
+                self.timer = loop.call_later(self.delay, self.flush)
+        return await asyncio.shield(fut)
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending
+        self.pending = {}
+        asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch: Dict[K, asyncio.Future]) -> None:
+        try:
+            results = await self.func(list(batch))
+        except Exception as e:
+            for fut in batch.values():
+                fut.set_exception(e)
+        else:
+            for key, fut in batch.items():
+                fut.set_result(results.get(key))
+
+
+class ordered(Generic[T]):
+    """Runs awaitables concurrently, at most as many at once as slots allows,
+    iterating over their results in order. Those still running on exit
+    are cancelled, and results that were never reached are passed to discard."""
+
+    def __init__(
+        self,
+        aws: Iterable[Awaitable[T]],
+        slots: Optional[asyncio.Semaphore] = None,
+        discard: Optional[Callable[[T], Any]] = None,
+    ):
+        self.aws = list(aws)
+        self.slots = slots
+        self.discard = discard
+        self.tasks: List[asyncio.Future] = []
+        self.reached = 0
+
+    async def run(self, aw: Awaitable[T]) -> T:
+        if self.slots is None:
+            return await aw
+        async with self.slots:
+            return await aw
+
+    async def results(self) -> AsyncIterator[T]:
+        for task in self.tasks:
+            result = await task
+            self.reached += 1
+            yield result
+
+    async def __aenter__(self) -> AsyncIterator[T]:
+        self.tasks = [asyncio.ensure_future(self.run(aw)) for aw in self.aws]
+        return self.results()
+
+    async def __aexit__(
+        self, exc_type: type, exc: Exception, tb: TracebackType
+    ) -> None:
+        for task in self.tasks:
+            task.cancel()
+        # retrieve exceptions of tasks that were never awaited
+        results = await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.discard is not None:
+            for result in results[self.reached :]:
+                if not isinstance(result, BaseException):
+                    self.discard(result)
+        for aw in self.aws:
+            if asyncio.iscoroutine(aw):
+                aw.close()  # type: ignore
+
+
+class Lease:
+    """A running slot of a FairScheduler. Releasing it more than once is harmless."""
+
+    def __init__(self, scheduler: "FairScheduler", key: Hashable, host: str):
+        self.scheduler: Optional[FairScheduler] = scheduler
+        self.key = key
+        self.host = host
+
+    def release(self) -> None:
+        if (scheduler := self.scheduler) is not None:
+            self.scheduler = None
+            scheduler.finish(self)
+
+
+class FairScheduler:
+    """Hands out up to limit concurrent slots, fairly between keys.
+
+    Each key has its own FIFO queue, served by weighted round-robin: a key
+    gets up to weights.get(key, 1) slots in a row before the next key's turn.
+    At most key_limit slots run per key and host_limit per host. Acquiring
+    raises QueueFull when the key already has max_queued waiters, except when
+    resuming work that gave up its slot, which goes to the front of the queue."""
+
+    def __init__(
+        self,
+        limit: int,
+        key_limit: int,
+        host_limit: int,
+        max_queued: int,
+        weights: Optional[Dict[Hashable, int]] = None,
+    ):
+        self.limit = limit
+        self.key_limit = key_limit
+        self.host_limit = host_limit
+        self.max_queued = max_queued
+        self.weights = weights or {}
+        self.queues: OrderedDict[
+            Hashable, Deque[Tuple[str, float, asyncio.Future]]
+        ] = OrderedDict()
+        self.credit: Dict[Hashable, int] = {}
+        self.running = 0
+        self.keys: Counter[Hashable] = Counter()
+        self.hosts: Counter[str] = Counter()
+        self.started = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self) -> int:
+        return sum(map(len, self.queues.values()))
+
+    async def acquire(self, key: Hashable, host: str, resume: bool = False) -> Lease:
+        queue = self.queues.setdefault(key, deque())
+        if not resume and len(queue) >= self.max_queued:
+            self.shed += 1
+            raise QueueFull(key)
+        fut = asyncio.get_event_loop().create_future()
+        job = (host, monotonic(), fut)
+        if resume:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        self.dispatch()
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                fut.result().release()
+            elif (waiting := self.queues.get(key)) is not None and job in waiting:
+                waiting.remove(job)
+                if not waiting:
+                    del self.queues[key]
+                    self.credit.pop(key, None)
+                self.dispatch()
+            raise
+
+    def finish(self, lease: Lease) -> None:
+        self.running -= 1
+        self.keys[lease.key] -= 1
+        if not self.keys[lease.key]:
+            del self.keys[lease.key]
+        self.hosts[lease.host] -= 1
+        if not self.hosts[lease.host]:
+            del self.hosts[lease.host]
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        blocked = 0
+        while self.running < self.limit and blocked < len(self.queues):
+            key, queue = next(iter(self.queues.items()))
+            job = None
+            if self.keys[key] < self.key_limit:
+                for i, job in enumerate(queue):
+                    host, _, fut = job
+                    if not fut.done() and self.hosts[host] < self.host_limit:
+                        del queue[i]
+                        break
+                else:
+                    job = None
+            if job is None:
+                self.queues.move_to_end(key)
+                self.credit.pop(key, None)
+                blocked += 1
+                continue
+            blocked = 0
+            self.start(key, *job)
+            credit = self.credit.get(key, self.weights.get(key, 1)) - 1
+            if not queue:
+                del self.queues[key]
+                self.credit.pop(key, None)
+            elif credit <= 0:
+                self.queues.move_to_end(key)
+                self.credit.pop(key, None)
+            else:
+                self.credit[key] = credit
+
+    def start(
+        self, key: Hashable, host: str, queued: float, fut: asyncio.Future
+    ) -> None:
+        self.running += 1
+        self.keys[key] += 1
+        self.hosts[host] += 1
+        wait = monotonic() - queued
+        self.started += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        fut.set_result(Lease(self, key, host))
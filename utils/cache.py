@@ -0,0 +1,160 @@
+from array import array
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Collection, Generic, List, Optional, Tuple, TypeVar, Union
+
+K = TypeVar("K")
+V = TypeVar("V")
+T = TypeVar("T")
+
+
+class TTLCache(Generic[K, V]):
+    """An LRU cache whose entries expire after a time to live.
+
+    If weigh is given, maxsize bounds the total weight of the entries
+    instead of their number."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        weigh: Optional[Callable[[V], int]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.size = 0
+        self.data: OrderedDict[K, Tuple[float, int, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key, _sentinel) is not _sentinel  # type: ignore
+
+    def get(self, key: K, default: T = None) -> Union[V, T]:  # type: ignore
+        try:
+            expires, _, value = self.data[key]
+        except KeyError:
+            return default
+        if expires <= monotonic():
+            self.pop(key)
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        self.pop(key)
+        weight = 1 if self.weigh is None else self.weigh(value)
+        if weight > self.maxsize:
+            return
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        self.data[key] = (expires, weight, value)
+        self.size += weight
+        while self.size > self.maxsize:
+            _, (_, weight, _) = self.data.popitem(last=False)
+            self.size -= weight
+
+    def pop(self, key: K, default: T = None) -> Union[V, T]:  # type: ignore
+        try:
+            _, weight, value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.size -= weight
+        return value
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.size = 0
+
+    def items(self) -> List[Tuple[K, V]]:
+        now = monotonic()
+        return [
+            (key, value)
+            for key, (expires, _, value) in self.data.items()
+            if expires > now
+        ]
+
+
+class SentMessages:
+    """Tracks which messages were sent in response to which.
+
+    Only (channel_id, message_id) pairs are stored, each with an integer tag,
+    packed into arrays. Entries expire ttl seconds after their last addition,
+    and the least recently added are evicted once more than maxlen pairs
+    are stored."""
+
+    def __init__(self, maxlen: int, ttl: float):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.length = 0
+        self.data: OrderedDict[int, Tuple[float, array]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return self.length
+
+    def add(self, key: int, channel_id: int, message_id: int, tag: int = 0) -> None:
+        try:
+            _, entries = self.data.pop(key)
+        except KeyError:
+            entries = array("Q")
+        entries.extend((tag, channel_id, message_id))
+        self.data[key] = (monotonic() + self.ttl, entries)
+        self.length += 1
+        self.evict()
+
+    def get(self, key: int) -> List[Tuple[int, int]]:
+        try:
+            expires, entries = self.data[key]
+        except KeyError:
+            return []
+        if expires <= monotonic():
+            self.pop(key)
+            return []
+        return list(zip(entries[1::3], entries[2::3]))
+
+    def pop(self, key: int) -> List[Tuple[int, int]]:
+        try:
+            expires, entries = self.data.pop(key)
+        except KeyError:
+            return []
+        self.length -= len(entries) // 3
+        if expires <= monotonic():
+            return []
+        return list(zip(entries[1::3], entries[2::3]))
+
+    def remove(self, key: int, tags: Collection[int]) -> List[Tuple[int, int]]:
+        """Remove and return the pairs stored under key with any of tags."""
+        try:
+            expires, entries = self.data[key]
+        except KeyError:
+            return []
+        if expires <= monotonic():
+            self.pop(key)
+            return []
+        kept = array("Q")
+        removed = []
+        for i in range(0, len(entries), 3):
+            tag, channel_id, message_id = entries[i : i + 3]
+            if tag in tags:
+                removed.append((channel_id, message_id))
+            else:
+                kept.extend((tag, channel_id, message_id))
+        self.length -= len(removed)
+        if kept:
+            self.data[key] = (expires, kept)
+        else:
+            del self.data[key]
+        return removed
+
+    def evict(self) -> None:
+        now = monotonic()
+        while self.data:
+            key, (expires, entries) = next(iter(self.data.items()))
+            if self.length <= self.maxlen and expires > now:
+                break
+            del self.data[key]
+            self.length -= len(entries) // 3
+
+
+_sentinel = object()
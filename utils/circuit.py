@@ -0,0 +1,176 @@
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Callable, Deque, Optional, TypeVar
+
+from .cache import TTLCache
+from .exceptions import CircuitOpen
+
+T = TypeVar("T")
+
+
+class CircuitBreaker:
+    """Fails fast for a host after threshold consecutive failures.
+
+    Once cooldown seconds have passed a single trial request is let through,
+    which closes the circuit again if it succeeds."""
+
+    def __init__(self, host: str, threshold: int = 5, cooldown: float = 30):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+
+    def check(self) -> bool:
+        """Raise CircuitOpen if requests shouldn't be sent to the host.
+        Returns whether the request about to be sent is the trial."""
+        if self.failures < self.threshold:
+            return False
+        if self.trial or monotonic() - self.opened_at < self.cooldown:
+            raise CircuitOpen(self.host)
+        self.trial = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = monotonic()
+        self.trial = False
+
+    def abort(self, trial: bool) -> None:
+        """Note that a request ended without showing whether the host is up,
+        letting another request be the trial if it was."""
+        if trial:
+            self.trial = False
+
+
+class RetryBudget:
+    """Limits retries to a fraction of requests, so retries can't multiply
+    load on a struggling host. Each request earns ratio of a retry,
+    up to a reserve of burst retries."""
+
+    def __init__(self, ratio: float = 0.1, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self) -> None:
+        self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdaptiveLimiter:
+    """Limits the requests in flight to a host, adjusting the limit by
+    additive increase and multiplicative decrease.
+
+    The limit grows by about one for every limit requests that succeed and
+    is halved, at most once per round trip, when a request fails, is rate
+    limited or takes more than slow times as long as the fastest recent one.
+    Requests can also be held back entirely for a while with pause."""
+
+    def __init__(
+        self,
+        initial: float = 4,
+        minimum: float = 1,
+        maximum: float = 64,
+        slow: float = 3,
+    ):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slow = slow
+        self.inflight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.paused_until = 0.0
+        self.fastest: Optional[float] = None
+        self.decreased_at = 0.0
+
+    async def acquire(self) -> None:
+        while True:
+            if (pause := self.paused_until - monotonic()) > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.inflight < int(self.limit):
+                break
+            fut = asyncio.get_event_loop().create_future()
+            self.waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self.wake()  # pass the wakeup on
+                else:
+                    self.waiters.remove(fut)
+                raise
+        self.inflight += 1
+
+    def release(self) -> None:
+        self.inflight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        free = int(self.limit) - self.inflight
+        while free > 0 and self.waiters:
+            self.waiters.popleft().set_result(None)
+            free -= 1
+
+    def succeeded(self, latency: float) -> None:
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        else:
+            # let the baseline drift up so one lucky request doesn't stick
+            self.fastest = min(latency, self.fastest * 1.05)
+        if latency > self.slow * self.fastest:
+            self.decrease()
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self.wake()
+
+    def failed(self) -> None:
+        self.decrease()
+
+    def decrease(self) -> None:
+        now = monotonic()
+        if now - self.decreased_at < (self.fastest or 1):
+            return
+        self.decreased_at = now
+        self.limit = max(self.limit / 2, self.minimum)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+
+# hosts that go unused for an hour are forgotten
+breakers: TTLCache[str, CircuitBreaker] = TTLCache(10_000, 60 * 60)
+budgets: TTLCache[str, RetryBudget] = TTLCache(10_000, 60 * 60)
+limiters: TTLCache[str, AdaptiveLimiter] = TTLCache(10_000, 60 * 60)
+
+
+def for_host(cache: TTLCache[str, T], host: str, factory: Callable[[], T]) -> T:
+    if (value := cache.get(host)) is None:
+        value = factory()
+    cache.set(host, value)  # renew it for as long as the host is in use
+    return value
+
+
+def breaker_for(host: str) -> CircuitBreaker:
+    return for_host(breakers, host, lambda: CircuitBreaker(host))
+
+
+def budget_for(host: str) -> RetryBudget:
+    return for_host(budgets, host, RetryBudget)
+
+
+def limiter_for(host: str) -> AdaptiveLimiter:
+    return for_host(limiters, host, AdaptiveLimiter)
@@ -1,14 +1,62 @@
+import asyncio
 import os
+import random
+from contextvars import ContextVar, Token
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
 from types import TracebackType
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-from aiohttp import ClientResponse, ClientSession, ServerDisconnectedError
+from aiohttp import (
+    ClientConnectionError,
+    ClientConnectorError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    ServerDisconnectedError,
+)
+from yarl import URL
 
+from .circuit import AdaptiveLimiter, breaker_for, budget_for, limiter_for
 from .exceptions import ResponseError
 
+# monotonic time by which requests made in the current context must be done
+deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def set_deadline(seconds: float) -> Token:
+    """Require requests in the current context to finish within seconds,
+    unless an earlier deadline is already set."""
+    when = monotonic() + seconds
+    if (current := deadline.get()) is not None:
+        when = min(when, current)
+    return deadline.set(when)
+
+
+def extend_deadline(seconds: float) -> None:
+    """Push the current context's deadline, if any, seconds later."""
+    if (current := deadline.get()) is not None:
+        deadline.set(current + seconds)
+
 
 class get:
-    """Returns a response to a URL."""
+    """Returns a response to a URL.
+
+    Idempotent requests are retried with jittered exponential backoff on
+    connection errors, timeouts, rate limiting and gateway errors, as long as
+    the host's retry budget and the current deadline allow. Requests to a host
+    that keeps failing raise CircuitOpen without being sent.
+
+    Requests in flight to each host are limited adaptively, and a host's
+    Retry-After holds back all requests to it."""
+
+    max_retries = 2
+    backoff = 0.5
+    max_retry_after = 300
+    retry_statuses = frozenset({429, 502, 503, 504})
+    idempotent = frozenset({"GET", "HEAD", "OPTIONS"})
+    # used when no deadline is set, so a hung upstream still times out
+    default_timeout = ClientTimeout(sock_connect=10, sock_read=30)
 
     def __init__(
         self, session: ClientSession, url: str, method: str = "GET", **kwargs: Any
@@ -21,22 +69,130 @@ class get:
         if "user-agent" not in headers:
             headers["user-agent"] = "BeattieBot/1.0 (BeatButton)"
         kwargs["headers"] = headers
-        if "timeout" not in kwargs:
-            kwargs["timeout"] = None
         self.kwargs = kwargs
         self.method = method
+        self.limiter: Optional[AdaptiveLimiter] = None
 
-    async def __aenter__(self) -> ClientResponse:
+    def timeout(self) -> ClientTimeout:
+        if (when := deadline.get()) is None:
+            return self.default_timeout
+        if (remaining := when - monotonic()) <= 0:
+            raise asyncio.TimeoutError
+        return ClientTimeout(total=remaining, sock_connect=10)
+
+    def retry_delay(
+        self, attempt: int, host: str, safe: bool, at_least: float = 0
+    ) -> Optional[float]:
+        """How long to wait before retrying, or None to give up."""
+        if attempt >= self.max_retries or not safe:
+            return None
+        delay = max(random.uniform(0, self.backoff * 2 ** attempt), at_least)
+        when = deadline.get()
+        if when is not None and monotonic() + delay >= when:
+            return None
+        if not budget_for(host).withdraw():
+            return None
+        return delay
+
+    def retry_after(self, resp: ClientResponse) -> float:
+        """Seconds the response asks to wait before trying again, if any."""
+        if (value := resp.headers.get("Retry-After")) is None:
+            return 0
         try:
-            self.resp = await self.session.request(self.method, self.url, **self.kwargs)
-        except ServerDisconnectedError:
-            return await self.__aenter__()
-        if self.resp.status != 200:
-            self.resp.close()
-            raise ResponseError(code=self.resp.status, url=self.resp.url)
-        return self.resp
+            seconds = float(value)
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return 0
+            seconds = when.timestamp() - time()
+        return min(max(seconds, 0), self.max_retry_after)
+
+    async def acquire(self, limiter: AdaptiveLimiter) -> Dict[str, Any]:
+        """Wait for a slot to send the request in.
+        Returns the arguments to send it with."""
+        if (when := deadline.get()) is None:
+            await limiter.acquire()
+        else:
+            await asyncio.wait_for(limiter.acquire(), when - monotonic())
+        if "timeout" in self.kwargs:
+            return self.kwargs
+        try:
+            return {**self.kwargs, "timeout": self.timeout()}
+        except BaseException:
+            limiter.release()
+            raise
+
+    async def __aenter__(self) -> ClientResponse:
+        host = URL(str(self.url)).host or ""
+        breaker = breaker_for(host)
+        limiter = limiter_for(host)
+        budget_for(host).deposit()
+        idempotent = self.method.upper() in self.idempotent
+        attempt = 0
+        while True:
+            # running out of time isn't the host's fault, so check before
+            # anything counts against it
+            self.timeout()
+            trial = breaker.check()
+            try:
+                kwargs = await self.acquire(limiter)
+            except BaseException:
+                breaker.abort(trial)
+                raise
+            start = monotonic()
+            try:
+                self.resp = await self.session.request(self.method, self.url, **kwargs)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                limiter.release()
+                if (when := deadline.get()) is not None and monotonic() >= when:
+                    # cut short by the deadline, which may not have left
+                    # the host a fair chance
+                    breaker.abort(trial)
+                    raise
+                limiter.failed()
+                breaker.failure()
+                # failing to connect or a dropped keep-alive connection
+                # are safe to retry whatever the method
+                safe = idempotent or isinstance(
+                    e, (ClientConnectorError, ServerDisconnectedError)
+                )
+                if (delay := self.retry_delay(attempt, host, safe)) is None:
+                    raise
+            except BaseException:
+                limiter.release()
+                breaker.abort(trial)
+                raise
+            else:
+                status = self.resp.status
+                if status < 500:
+                    breaker.success()
+                else:
+                    breaker.failure()
+                if status == 429 or status >= 500:
+                    limiter.failed()
+                else:
+                    limiter.succeeded(monotonic() - start)
+                if status == 200:
+                    self.limiter = limiter
+                    return self.resp
+                limiter.release()
+                self.resp.close()
+                retry_after = 0.0
+                if status in (429, 503):
+                    retry_after = self.retry_after(self.resp)
+                    limiter.pause(retry_after)
+                safe = idempotent and status in self.retry_statuses
+                delay = self.retry_delay(attempt, host, safe, retry_after)
+                if delay is None:
+                    raise ResponseError(code=status, url=self.resp.url)
+            await asyncio.sleep(delay)
+            attempt += 1
 
     async def __aexit__(
         self, exc_type: type, exc: Exception, tb: TracebackType
     ) -> None:
         self.resp.close()
+        if self.limiter is not None:
+            self.limiter.release()
+            self.limiter = None
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import IO, Dict, Optional
+
+
+class DiskCache:
+    """A persistent, content-addressed file cache with LRU eviction.
+
+    Keys are mapped to the SHA-256 digest of their content, so identical files
+    stored under different keys share a single blob on disk. The index is only
+    written out by dump, which should be called periodically."""
+
+    def __init__(self, path: str, max_size: int):
+        self.path = Path(path)
+        self.blob_path = self.path / "blobs"
+        self.index_path = self.path / "index.json"
+        self.max_size = max_size
+        self.keys: Dict[str, str] = {}
+        self.blobs: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.blob_path.mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.index_path) as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            index = {}
+        for digest, size in index.get("blobs", []):
+            if (self.blob_path / digest).is_file():
+                self.blobs[digest] = size
+                self.size += size
+        self.keys = {
+            key: digest
+            for key, digest in index.get("keys", {}).items()
+            if digest in self.blobs
+        }
+        # blobs stored after the index was last written
+        for path in self.blob_path.iterdir():
+            if path.name not in self.blobs:
+                path.unlink()
+        self.evict()
+
+    def dump(self) -> None:
+        """Write the index to disk if it changed since it was last written."""
+        with self.lock:
+            if not self.dirty:
+                return
+            index = {"keys": dict(self.keys), "blobs": list(self.blobs.items())}
+            self.dirty = False
+        fp = NamedTemporaryFile("w", dir=self.path, delete=False)
+        try:
+            with fp:
+                json.dump(index, fp)
+            os.replace(fp.name, self.index_path)
+        except BaseException:
+            self.dirty = True
+            os.unlink(fp.name)
+            raise
+
+    def get(self, key: str) -> Optional[Path]:
+        with self.lock:
+            if (digest := self.keys.get(key)) is None:
+                return None
+            path = self.blob_path / digest
+            if not path.is_file():  # deleted behind our back
+                self.drop(digest)
+                return None
+            self.blobs.move_to_end(digest)
+        return path
+
+    def open(self, key: str) -> Optional[IO[bytes]]:
+        """Open the file stored under key, or return None if there is none."""
+        if (path := self.get(key)) is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:  # evicted in the meantime
+            with self.lock:
+                self.drop(path.name)
+            return None
+
+    def put(self, key: str, fp: IO[bytes]) -> Path:
+        """Store the remaining contents of fp under key.
+        The file position is restored afterwards."""
+        start = fp.tell()
+        hasher = sha256()
+        size = 0
+        with NamedTemporaryFile(dir=self.path, delete=False) as tmp:
+            while chunk := fp.read(1 << 16):
+                hasher.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        fp.seek(start)
+        digest = hasher.hexdigest()
+        path = self.blob_path / digest
+        with self.lock:
+            if digest in self.blobs:
+                os.unlink(tmp.name)
+                self.blobs.move_to_end(digest)
+            else:
+                os.replace(tmp.name, path)
+                self.blobs[digest] = size
+                self.size += size
+            self.keys[key] = digest
+            self.dirty = True
+            self.evict()
+        return path
+
+    def drop(self, digest: str) -> None:
+        """Forget a blob and every key stored in it. Call with lock held."""
+        if (size := self.blobs.pop(digest, None)) is not None:
+            self.size -= size
+        self.keys = {k: v for k, v in self.keys.items() if v != digest}
+        self.dirty = True
+
+    def evict(self) -> None:
+        evicted = set()
+        # the most recently used blob is always kept, even if it alone is too large
+        while self.size > self.max_size and len(self.blobs) > 1:
+            digest, size = self.blobs.popitem(last=False)
+            self.size -= size
+            evicted.add(digest)
+            try:
+                (self.blob_path / digest).unlink()
+            except FileNotFoundError:
+                pass
+        if evicted:
+            self.keys = {k: v for k, v in self.keys.items() if v not in evicted}
+            self.dirty = True
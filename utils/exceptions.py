@@ -10,3 +10,28 @@ class ResponseError(Exception):
         self.code = code
         self.url = url
         super().__init__(code, *args)
+
+
+class FileTooLarge(Exception):
+    """For throwing when a download exceeds its size limit."""
+
+    def __init__(self, size: Optional[int] = None, url: Optional[str] = None):
+        self.size = size
+        self.url = url
+        super().__init__(size, url)
+
+
+class ResolveError(Exception):
+    """For throwing when a post's metadata can't be looked up."""
+
+
+class QueueFull(Exception):
+    """For throwing when work is shed because too much is already queued."""
+
+
+class CircuitOpen(Exception):
+    """For throwing when requests to a host that keeps failing are cut short."""
+
+    def __init__(self, host: str):
+        self.host = host
+        super().__init__(host)
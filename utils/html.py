@@ -0,0 +1,21 @@
+from typing import Callable, Optional
+
+from aiohttp import ClientResponse
+from lxml import etree
+
+
+async def parse_html(
+    resp: ClientResponse, stop: Optional[Callable[[etree._Element], bool]] = None
+) -> etree._Element:
+    """Incrementally parse an HTML response and return the root element.
+
+    Once stop returns True for a closed element, the rest of the body
+    is neither read nor parsed."""
+    parser = etree.HTMLPullParser(events=("end",) if stop is not None else ())
+    async for chunk in resp.content.iter_chunked(1 << 14):
+        parser.feed(chunk)
+        if stop is not None:
+            for _, element in parser.read_events():
+                if stop(element):
+                    return parser.close()
+    return parser.close()
@@ -0,0 +1,124 @@
+import math
+import time
+from io import BytesIO
+from typing import IO, List, Optional, Tuple
+from zipfile import ZipFile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # type: ignore
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None  # type: ignore
+
+
+def limit_cpu(seconds: float) -> None:
+    """Have the kernel kill the current process once it uses seconds more
+    CPU time, for work that can't be interrupted otherwise."""
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(used + seconds)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def fit_image(path: str, limit: int, cpu_budget: float) -> Optional[bytes]:
+    """Re-encode the image at path to at most limit bytes, downscaling as needed.
+
+    Opaque images become progressive JPEGs, images with transparency become WebP.
+    Returns None if the image can't be made to fit within cpu_budget seconds of
+    CPU time. Meant to be run in a worker process, which is killed if a single
+    encode runs well over the budget."""
+    start = time.process_time()
+    limit_cpu(cpu_budget * 2)
+    with Image.open(path) as src:
+        if getattr(src, "is_animated", False):
+            return None
+        src.load()
+        alpha = src.mode in ("RGBA", "LA", "PA") or "transparency" in src.info
+        img = src.convert("RGBA" if alpha else "RGB")
+    width, height = img.size
+    scale = 1.0
+    while width * scale >= 64 and height * scale >= 64:
+        if scale < 1:
+            dims = (int(width * scale), int(height * scale))
+            frame = img.resize(dims, Image.Resampling.LANCZOS)
+        else:
+            frame = img
+        for quality in (90, 75):
+            buf = BytesIO()
+            if alpha:
+                frame.save(buf, "WEBP", quality=quality, method=4)
+            else:
+                frame.save(buf, "JPEG", quality=quality, progressive=True)
+            if (size := buf.tell()) <= limit:
+                return buf.getvalue()
+            if time.process_time() - start > cpu_budget:
+                return None
+        # file size scales roughly with pixel count
+        scale *= min(0.9, (limit / size) ** 0.5 * 0.95)
+    return None
+
+
+def make_gif(
+    path: str, frames: List[Tuple[str, int]], limit: int, cpu_budget: float
+) -> Optional[bytes]:
+    """Assemble the frames of the zip archive at path into a looping GIF of at most
+    limit bytes. frames holds the file name and delay in milliseconds of each frame.
+
+    Returns None if the GIF can't be made to fit within cpu_budget seconds of
+    CPU time. Meant to be run in a worker process, which is killed if a single
+    encode runs well over the budget."""
+    start = time.process_time()
+    limit_cpu(cpu_budget * 2)
+    images = []
+    with ZipFile(path) as archive:
+        for name, _ in frames:
+            with archive.open(name) as fp, Image.open(fp) as img:
+                images.append(img.convert("RGB"))
+    durations = [delay for _, delay in frames]
+    width, height = images[0].size
+    scale = 1.0
+    while width * scale >= 64 and height * scale >= 64:
+        if scale < 1:
+            dims = (int(width * scale), int(height * scale))
+            resized = [img.resize(dims, Image.Resampling.LANCZOS) for img in images]
+        else:
+            resized = images
+        buf = BytesIO()
+        resized[0].save(
+            buf,
+            "GIF",
+            save_all=True,
+            append_images=resized[1:],
+            duration=durations,
+            loop=0,
+        )
+        if (size := buf.tell()) <= limit:
+            return buf.getvalue()
+        if time.process_time() - start > cpu_budget:
+            return None
+        scale *= min(0.9, (limit / size) ** 0.5 * 0.95)
+    return None
+
+
+def guess_extension(fp: IO[bytes]) -> str:
+    pos = fp.tell()
+    header = fp.read(12)
+    fp.seek(pos)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if header[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if header[:4] == b"GIF8":
+        return "gif"
+    return "bin"
@@ -0,0 +1,118 @@
+from collections import Counter, defaultdict
+from math import frexp
+from time import monotonic
+from typing import Any, Dict, Hashable, Iterable, List, Tuple
+
+
+class RollingCounter:
+    """Per-key totals over a sliding window of the last window seconds,
+    kept at a resolution of window / buckets seconds."""
+
+    def __init__(self, window: float, buckets: int = 24):
+        self.width = window / buckets
+        self.buckets = buckets
+        self.data: Dict[Hashable, Tuple[int, List[int]]] = {}
+
+    def advance(self, key: Hashable) -> List[int]:
+        now = int(monotonic() // self.width)
+        try:
+            start, counts = self.data[key]
+        except KeyError:
+            start, counts = now, [0] * self.buckets
+        if (shift := now - start) >= self.buckets:
+            counts = [0] * self.buckets
+        elif shift > 0:
+            counts = counts[shift:] + [0] * shift
+        self.data[key] = (now, counts)
+        return counts
+
+    def add(self, key: Hashable, amount: int) -> None:
+        self.advance(key)[-1] += amount
+
+    def total(self, key: Hashable) -> int:
+        if key not in self.data:
+            return 0
+        counts = self.advance(key)
+        if not any(counts):
+            del self.data[key]
+            return 0
+        return sum(counts)
+
+
+class Histogram:
+    """Distribution of positive values in logarithmic buckets,
+    8 per power of two, so quantiles are accurate to within 12.5%."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: Counter[int] = Counter()
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value > 0:
+            mantissa, exponent = frexp(value)
+            self.buckets[exponent * 8 + int((mantissa - 0.5) * 16)] += 1
+        else:
+            self.buckets[-(1 << 16)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the q-quantile falls in."""
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        else:
+            return self.max
+        if index == -(1 << 16):
+            return 0.0
+        exponent, sub = divmod(index, 8)
+        return min((0.5 + (sub + 1) / 16) * 2.0 ** exponent, self.max)
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """Named counters and histograms, each kept separately per label.
+    Every observation is recorded under all of the labels given."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Counter[str]] = defaultdict(Counter)
+        self.histograms: Dict[str, Dict[str, Histogram]] = defaultdict(dict)
+
+    def incr(self, name: str, labels: Iterable[str], amount: int = 1) -> None:
+        counter = self.counters[name]
+        for label in labels:
+            counter[label] += amount
+
+    def observe(self, name: str, labels: Iterable[str], value: float) -> None:
+        histograms = self.histograms[name]
+        for label in labels:
+            if (histogram := histograms.get(label)) is None:
+                histogram = histograms[label] = Histogram()
+            histogram.observe(value)
+
+    def dump(self) -> Dict[str, Any]:
+        return {
+            "counters": {
+                name: dict(counter) for name, counter in self.counters.items()
+            },
+            "histograms": {
+                name: {label: hist.summary() for label, hist in histograms.items()}
+                for name, histograms in self.histograms.items()
+            },
+        }
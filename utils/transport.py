@@ -0,0 +1,85 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+from aiohttp import ClientSession, TCPConnector, TraceConfig
+
+from .cache import TTLCache
+
+
+class ConnectionStats:
+    """Counts new and reused connections and DNS cache use per host,
+    gathered through aiohttp request tracing.
+
+    Hosts that go unused for ttl seconds are forgotten, as are the least
+    recently used once there are more than max_hosts."""
+
+    events = ("requests", "created", "reused", "dns_hits", "dns_misses")
+
+    def __init__(self, max_hosts: int = 10_000, ttl: float = 60 * 60 * 24) -> None:
+        self.hosts: TTLCache[Optional[str], Counter[str]] = TTLCache(max_hosts, ttl)
+        self.trace_config = TraceConfig()
+        self.trace_config.on_request_start.append(self.on_request_start)
+        self.trace_config.on_connection_create_end.append(self.count("created"))
+        self.trace_config.on_connection_reuseconn.append(self.count("reused"))
+        self.trace_config.on_dns_cache_hit.append(self.count("dns_hits"))
+        self.trace_config.on_dns_cache_miss.append(self.count("dns_misses"))
+
+    def incr(self, host: Optional[str], event: str) -> None:
+        if (counts := self.hosts.get(host)) is None:
+            counts = Counter()
+        counts[event] += 1
+        self.hosts.set(host, counts)  # renew it for as long as the host is in use
+
+    async def on_request_start(
+        self, session: ClientSession, ctx: SimpleNamespace, params: Any
+    ) -> None:
+        ctx.host = params.url.host
+        self.incr(ctx.host, "requests")
+
+    def count(self, event: str) -> Any:
+        async def handler(
+            session: ClientSession, ctx: SimpleNamespace, params: Any
+        ) -> None:
+            self.incr(getattr(ctx, "host", None), event)
+
+        return handler
+
+    def dump(self) -> Dict[Optional[str], Dict[str, int]]:
+        return {
+            host: {event: counts[event] for event in self.events}
+            for host, counts in self.hosts.items()
+        }
+
+
+class Transport:
+    """A connection pool shared by any number of sessions.
+
+    Connections are capped in total and per host, idle connections are kept
+    alive for reuse and DNS results are cached. Sessions made by the transport
+    keep their own cookies and default headers."""
+
+    def __init__(
+        self, config: Dict[str, Any], loop: Optional[asyncio.AbstractEventLoop] = None
+    ):
+        self.connector = TCPConnector(
+            limit=config.get("limit", 100),
+            limit_per_host=config.get("limit_per_host", 10),
+            ttl_dns_cache=config.get("dns_ttl", 300),
+            keepalive_timeout=config.get("keepalive_timeout", 30),
+            enable_cleanup_closed=True,
+            loop=loop,
+        )
+        self.stats = ConnectionStats()
+
+    def session(self, **kwargs: Any) -> ClientSession:
+        return ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            trace_configs=[self.stats.trace_config],
+            **kwargs,
+        )
+
+    async def close(self) -> None:
+        await self.connector.close()